@@ -1,16 +1,32 @@
 import dataiku
 from dataiku.customrecipe import get_output_names_for_role, get_input_names_for_role, get_recipe_config
 import logging
-from dku_email_client import SmtpConfig, SmtpEmailClient, ChannelClient
+from dku_email_client import SmtpConfig, SmtpEmailClient, AsyncSmtpEmailClient, ChannelClient, DryRunEmailClient
 from dss_selector_choices import SENDER_SUFFIX
-from dku_attachment_handling import build_attachment_files, attachments_template_dict
-from email_utils import build_email_subject, build_email_message_text
-from jinja2 import Environment, StrictUndefined
-import json
+from dku_attachment_handling import build_attachment_files, attachments_template_dict, PartitionedAttachments
+from dku_attachment_cache import AttachmentExportCache
+from email_utils import build_email_subject, build_email_message_text, RenderedEmail, CompiledTemplate
+from dku_concurrency import ordered_map, ordered_submit, Pipeline, PipelineStage, ShardedRunner
+from dku_batching import send_in_batches
+from dku_metrics import METRICS, METRICS_SCHEMA, timed_iter
+from dku_rate_limiting import AdaptiveRateLimiter, RetryPolicy
+from dku_send_journal import SendJournal, with_row_keys, ROW_KEY_COLUMN
+from dku_recipients import parse_recipients, check_recipients, DuplicateFilter
+from dku_contacts import ContactReader, ROW_NUMBER_COLUMN
+from dku_batched_writer import BatchedWriter
+from dku_dss_api import get_messaging_channel, supports_messaging_channels
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import time
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
-jinja_env = Environment(undefined=StrictUndefined)
+
+def create_jinja_env():
+    # Imported here, so that runs without templates do not load JINJA
+    from jinja2 import Environment, StrictUndefined
+    return Environment(undefined=StrictUndefined)
+
 
 def read_smtp_config(recipe_config):
     """ Extract SmtpConfig (named tuple) from recipe_config dict """
@@ -34,23 +50,14 @@ def to_real_channel_id(channel_id):
 def does_channel_have_sender(channel_id):
     return channel_id is not None and channel_id.endswith(SENDER_SUFFIX)
 
-# Takes a string and returns a list of one or more address values
-def parse_recipients(recipients):
-    try:
-        # JSON array case
-        value = json.loads(recipients)
-        if isinstance(value, list):
-            return value
-    except json.decoder.JSONDecodeError:
-        pass
-    # Other cases - either a single value or comma separated string `name@place.com, name2@place.com`
-    return recipients.split(",")
-
 # Get handles on datasets
 output_A_names = get_output_names_for_role('output')
 output = dataiku.Dataset(output_A_names[0]) if len(output_A_names) > 0 else None
 project_key = output.project_key
 
+metrics_names = get_output_names_for_role('metrics')
+metrics_output = dataiku.Dataset(metrics_names[0]) if len(metrics_names) > 0 else None
+
 people = dataiku.Dataset(get_input_names_for_role('contacts')[0])
 attachment_datasets = [dataiku.Dataset(x) for x in get_input_names_for_role('attachments')]
 
@@ -85,6 +92,88 @@ mail_channel = config.get('mail_channel', None)
 channel_has_sender = does_channel_have_sender(mail_channel)
 
 attachment_type = config.get('attachment_type', "send_no_attachments")
+# Number of rows of each attachment dataset available to the body template
+attachment_preview_rows = max(1, int(config.get('attachment_preview_rows', 50) or 50))
+# Per contact attachments - only the attachment rows whose key column matches the contact key column are sent
+filter_attachments = config.get('filter_attachments', False) and attachment_type != "send_no_attachments"
+attachment_contact_key_column = config.get('attachment_contact_key_column', None)
+attachment_dataset_key_column = config.get('attachment_dataset_key_column', None)
+# Number of attachment datasets exported or read from DSS at the same time
+attachment_fetch_workers = max(1, int(config.get('attachment_fetch_workers', 4) or 4))
+# Local folder keeping the attachment exports between runs, so unchanged attachment datasets are not exported again
+attachment_cache_dir = config.get('attachment_cache_dir', None)
+# 'zip' or 'gzip' to send compressed attachments, compressed while they are exported
+attachment_compression = config.get('attachment_compression', 'none')
+attachment_compression = None if attachment_compression in (None, '', 'none') else attachment_compression
+# Limit of the relay on the size of messages - larger attachments are compressed, emails still too large are not sent. 0 for no limit
+max_message_size = int(float(config.get('max_message_size_mb', 0) or 0) * 1024 * 1024)
+
+# Number of SMTP connections (and sending threads) used in parallel
+smtp_pool_size = max(1, int(config.get('smtp_pool_size', 1) or 1))
+# Limits of the SMTP relay - 0 means no limit
+smtp_max_rate = float(config.get('smtp_max_rate', 0) or 0)
+smtp_max_messages_per_connection = max(0, int(config.get('smtp_max_messages_per_connection', 0) or 0))
+smtp_max_retries = max(0, int(config.get('smtp_max_retries', 3) or 0))
+# Asyncio SMTP client - up to smtp_max_in_flight emails are sent at the same time over the connections, without a thread each
+smtp_use_asyncio = config.get('smtp_use_asyncio', False)
+smtp_max_in_flight = max(1, int(config.get('smtp_max_in_flight', 100) or 100))
+
+# Pipelined mode - rendering and sending are done by separate pools of workers, connected by bounded queues
+use_pipeline = config.get('use_pipeline', False)
+render_workers = max(1, int(config.get('render_workers', 1) or 1))
+pipeline_queue_size = max(1, int(config.get('pipeline_queue_size', 100) or 100))
+
+# Sharded mode - rows are split between several processes, each with its own email client, so rendering uses several cores
+send_processes = max(1, int(config.get('send_processes', 1) or 1))
+# 'rows' to send blocks of consecutive rows to each process, 'recipient' to always send the same recipient from the same process
+shard_by = config.get('shard_by', 'rows')
+
+# Batched mode (channels only) - up to channel_batch_size recipients of identical emails per channel call
+channel_batch_size = max(1, int(config.get('channel_batch_size', 1) or 1))
+use_batching = channel_batch_size > 1 and not (mail_channel is None or mail_channel == '__DKU__DIRECT_SMTP__')
+# Number of rows looked at together to find identical emails
+batch_window_size = 10 * channel_batch_size
+
+# Checkpoint journal of delivered emails, to resume a failed run without sending emails twice
+use_journal = config.get('use_journal', False)
+journal_path = config.get('journal_path', None)
+journal_resume = config.get('journal_resume', False)
+journal_key_column = config.get('journal_key_column', None)
+
+# Pre-pass over the recipient column - invalid addresses are reported without being sent to
+validate_recipients = config.get('validate_recipients', False)
+# A recipient listed in several rows with an identical email only gets it once
+deduplicate_recipients = config.get('deduplicate_recipients', False)
+
+# Whether to add the time spent rendering and sending each row to the output
+metrics_per_row = config.get('metrics_per_row', False)
+
+# Slim output - only the row number and recipient of each row are written with the sendmail columns, not the whole row
+slim_output = config.get('slim_output', False)
+# Output rows are written by batches, of at most output_batch_size rows and output_flush_interval seconds
+output_batch_size = max(1, int(config.get('output_batch_size', 1000) or 1000))
+output_flush_interval = float(config.get('output_flush_interval', 10) or 10)
+
+# Dry run - emails are rendered and built but not sent, the size of each is written to the output. The first ones can be sent
+# to dry_run_sample_recipient through the real relay (or channel), to project how long the actual run would take
+dry_run = config.get('dry_run', False)
+dry_run_sample_recipient = config.get('dry_run_sample_recipient', None)
+dry_run_sample_size = max(0, int(config.get('dry_run_sample_size', 10) or 0))
+if dry_run:
+    # Nothing is delivered, so there is nothing to record - and every row is built on its own, so that its size can be reported
+    use_journal = False
+    use_batching = False
+
+is_direct_smtp = mail_channel is None or mail_channel == '__DKU__DIRECT_SMTP__'
+
+# Calls to DSS needed before the first email can be sent are made at the same time
+startup_executor = ThreadPoolExecutor(max_workers=4)
+people_schema_future = startup_executor.submit(people.read_schema)
+if not is_direct_smtp and send_processes == 1:
+    # Looked up ahead of the creation of the email client, which then gets it from the cache
+    startup_executor.submit(get_messaging_channel, to_real_channel_id(mail_channel))
+if apply_coloring_excel:
+    startup_executor.submit(supports_messaging_channels)
 
 # Validation part 1 - Check some kind of value/column exists for body, subject, sender and recipient
 
@@ -112,7 +201,8 @@ if not recipient_column:
 
 
 # Validation part 2 - when necessary, check the column values provided are in the contacts (people) dataset
-people_columns = [p['name'] for p in people.read_schema()]
+people_schema = people_schema_future.result()
+people_columns = [p['name'] for p in people_schema]
 for arg in ['subject', 'body']:
     if not globals()["use_" + arg + "_value"] and globals()[arg + "_column"] not in people_columns:
         raise AttributeError("The column you specified for %s (%s) was not found." % (arg, globals()[arg + "_column"]))
@@ -123,72 +213,536 @@ if not channel_has_sender and not use_sender_value and sender_column not in peop
 if recipient_column not in people_columns:
     raise AttributeError("The column you specified for recipient (%s) was not found." % recipient_column)
 
+if filter_attachments:
+    if attachment_contact_key_column not in people_columns:
+        raise AttributeError("The column you specified for the contact attachment key (%s) was not found." % attachment_contact_key_column)
+    if not attachment_dataset_key_column:
+        raise AttributeError("No attachment key column provided to filter attachments")
+
+if use_journal:
+    if not journal_path:
+        raise AttributeError("No path provided for the journal")
+    if journal_key_column and journal_key_column not in people_columns:
+        raise AttributeError("The column you specified for the journal row key (%s) was not found." % journal_key_column)
+
 
 # Create Jinja templates if needed
 
+jinja_env = create_jinja_env() if use_body_value or use_subject_value else None
+
 body_template = None
 if use_body_value:
     if body_format == 'html':
-        body_template = jinja_env.from_string(html_body_value)
+        body_template = CompiledTemplate(jinja_env, html_body_value)
     else:
-        body_template = jinja_env.from_string(body_value)
+        body_template = CompiledTemplate(jinja_env, body_value)
+    logging.info(f"Body template references: {sorted(body_template.variables)}")
 
 subject_template = None
 if use_subject_value:
-    subject_template = jinja_env.from_string(subject_value)
+    subject_template = CompiledTemplate(jinja_env, subject_value)
+    logging.info(f"Subject template references: {sorted(subject_template.variables)}")
+
+# Only the columns used to build the emails are put in the contact dicts, the rest of each row is kept as is for the output
+context_columns = {recipient_column, attachment_contact_key_column, journal_key_column}
+if not use_sender_value:
+    context_columns.add(sender_column)
+for arg, template in [('subject', subject_template), ('body', body_template)]:
+    if template:
+        context_columns.update(template.variables)
+    else:
+        context_columns.add(globals()[arg + "_column"])
+if use_journal and not journal_key_column:
+    # The row key is a hash of the whole row
+    context_columns.update(people_columns)
+contact_reader = ContactReader(people, people_columns, context_columns, [recipient_column] if slim_output else None)
+logging.info(f"Columns used to build the emails: {contact_reader.context_columns}, columns read: {len(contact_reader.read_columns)}")
 
 # Write schema
-output_schema = list(people.read_schema())
-output_schema.append({'name': 'sendmail_status', 'type': 'string'})
-output_schema.append({'name': 'sendmail_error', 'type': 'string'})
+if slim_output:
+    output_schema = [{'name': ROW_NUMBER_COLUMN, 'type': 'bigint'}] + [c for c in people_schema if c['name'] == recipient_column]
+else:
+    output_schema = list(people_schema)
+# Output columns added after those of the contacts
+sendmail_schema = [{'name': 'sendmail_status', 'type': 'string'}, {'name': 'sendmail_error', 'type': 'string'}]
+if use_journal:
+    sendmail_schema.append({'name': ROW_KEY_COLUMN, 'type': 'string'})
+if metrics_per_row:
+    sendmail_schema.append({'name': 'sendmail_duration_ms', 'type': 'double'})
+if dry_run:
+    sendmail_schema.append({'name': 'sendmail_size_bytes', 'type': 'bigint'})
+output_schema += sendmail_schema
 output.write_schema(output_schema)
+extra_output_columns = [column['name'] for column in sendmail_schema]
+output_column_names = [column['name'] for column in output_schema]
+
+use_async_smtp = is_direct_smtp and smtp_use_asyncio and not dry_run
+send_workers = smtp_pool_size if is_direct_smtp else 1
+
+
+def create_email_client(null_transport=dry_run):
+    if null_transport:
+        return DryRunEmailClient(not use_html_body_value)
+    if is_direct_smtp:
+        # Limits apply per process
+        rate_limiter = AdaptiveRateLimiter(smtp_max_rate / send_processes) if smtp_max_rate > 0 else None
+        # Not use_async_smtp: the relay sample of a dry run is sent with the client of the actual run
+        client_class = AsyncSmtpEmailClient if smtp_use_asyncio else SmtpEmailClient
+        return client_class(not use_html_body_value, read_smtp_config(config), smtp_pool_size, rate_limiter,
+                            smtp_max_messages_per_connection, RetryPolicy(smtp_max_retries))
+    return ChannelClient(not use_html_body_value, to_real_channel_id(mail_channel), channel_batch_size)
+
 
-attachment_files = build_attachment_files(attachment_datasets, attachment_type, apply_coloring_excel)
+def create_logged_in_email_client():
+    created_client = create_email_client()
+    created_client.login()
+    return created_client
 
-attachments_templating_dict = attachments_template_dict(attachment_datasets, project_key, apply_coloring_excel)
 
-if mail_channel is None or mail_channel == '__DKU__DIRECT_SMTP__':
-    email_client = SmtpEmailClient(not use_html_body_value, read_smtp_config(config))
+# All the reads of attachment datasets (exports and templating data) share a bounded pool of threads
+attachment_executor = ThreadPoolExecutor(max_workers=attachment_fetch_workers)
+
+# Attachments are exported while the email client connects
+if filter_attachments:
+    # Each attachment dataset is read once, then files are generated per key when first needed
+    attachments_future = startup_executor.submit(PartitionedAttachments, attachment_datasets, attachment_type, attachment_dataset_key_column,
+                                                 executor=attachment_executor, compression=attachment_compression,
+                                                 max_message_size=max_message_size)
 else:
-    email_client = ChannelClient(not use_html_body_value, to_real_channel_id(mail_channel))
-email_client.login()
+    export_cache = AttachmentExportCache(attachment_cache_dir) if attachment_cache_dir else None
+    attachments_future = startup_executor.submit(build_attachment_files, attachment_datasets, attachment_type, apply_coloring_excel,
+                                                 attachment_executor, export_cache, attachment_compression, max_message_size)
+# In sharded mode, each sending process creates its own client
+email_client_future = startup_executor.submit(create_logged_in_email_client) if send_processes == 1 else None
+
 
+def quit_started_email_client():
+    """ Close the connections of the email client created at startup, when another startup call failed """
+    try:
+        started_client = email_client_future.result()
+    except Exception:
+        return
+    started_client.quit()
+
+
+email_client = None
+try:
+    # Only read the attachment datasets the body template actually references
+    attachments_templating_dict = {}
+    if body_template and body_template.uses_attachments():
+        referenced_names = body_template.attachment_references
+        templated_datasets = [ds for ds in attachment_datasets
+                              if referenced_names is None or ds.full_name.split(".")[1] in referenced_names or ds.project_key in referenced_names]
+        attachments_templating_dict = attachments_template_dict(templated_datasets, project_key, apply_coloring_excel, attachment_preview_rows,
+                                                                attachment_executor)
+
+    if filter_attachments:
+        attachment_files = None
+        partitioned_attachments = attachments_future.result()
+    else:
+        attachment_files = attachments_future.result()
+        partitioned_attachments = None
+    email_client = email_client_future.result() if email_client_future else None
+finally:
+    if email_client is None and email_client_future:
+        quit_started_email_client()
+startup_executor.shutdown()
+# Templating data may still be being read, it is waited for when a template accesses it - except before forking the sending
+# processes, which would otherwise copy the locks of the entries still being read in the held state, and wait for them forever
+attachment_executor.shutdown(wait=send_processes > 1)
+
+journal = SendJournal(journal_path, journal_resume) if use_journal else None
+duplicate_filter = DuplicateFilter() if deduplicate_recipients else None
+
+# Key of the contact dict holding the addresses found by the recipient pre-pass, removed before the row is written
+CHECKED_RECIPIENTS_KEY = "__sendmail_checked_recipients"
+
+
+def render_contact(contact_dict):
+    """
+    Render the email for one contact
+    :returns: tuple of the contact_dict and the RenderedEmail - None if rendering failed, the contact_dict then has the FAILED status set
+    """
+    start = time.perf_counter()
+    rendered_contact = render_contact_untimed(contact_dict)
+    if metrics_per_row:
+        add_row_duration(rendered_contact[0], start)
+    return rendered_contact
+
+
+def add_row_duration(contact_dict, start):
+    duration_ms = 1000 * (time.perf_counter() - start)
+    contact_dict['sendmail_duration_ms'] = contact_dict.get('sendmail_duration_ms', 0.0) + duration_ms
+
+
+def render_content(contact_dict):
+    """ :returns: tuple (sender, subject, body) of the email of a contact """
+    email_subject = build_email_subject(use_subject_value, subject_template, subject_column, contact_dict)
+    email_body_text = build_email_message_text(use_body_value, body_template, attachments_templating_dict, contact_dict, body_column,
+                                               use_html_body_value)
+    # Note - if the channel has a sender configured, the sender value will be ignored by the email client here
+    sender = sender_value if use_sender_value else contact_dict.get(sender_column, "")
+    return sender, email_subject, email_body_text
+
+
+def contact_attachment_files_for(contact_dict):
+    if partitioned_attachments:
+        return partitioned_attachments.files_for(contact_dict.get(attachment_contact_key_column))
+    return attachment_files
+
+
+def render_contact_untimed(contact_dict):
+    checked_recipients = contact_dict.pop(CHECKED_RECIPIENTS_KEY, None)
+    if journal:
+        completed_row = journal.completed_row(contact_dict[ROW_KEY_COLUMN])
+        if completed_row is not None:
+            # Sent by a previous run - the output row is rebuilt from the journal
+            return completed_row, None
+    recipients_string = contact_dict[recipient_column]
+    if checked_recipients is not None:
+        recipients, invalid_recipients = checked_recipients
+        if not recipients:
+            # Nothing to send - reported without rendering nor any network call
+            contact_dict['sendmail_status'] = 'INVALID'
+            contact_dict['sendmail_error'] = f"Invalid recipient address(es): {', '.join(invalid_recipients)}" if invalid_recipients \
+                else "No recipient"
+            return contact_dict, None
+        if invalid_recipients:
+            contact_dict['sendmail_error'] = f"Not sent to invalid recipient address(es): {', '.join(invalid_recipients)}"
+    if recipients_string:
+        logging.info("Sending to %s" % recipients_string)
+    else:
+        logging.info("No recipient for row - emailing will fail - row data: %s" % contact_dict)
+    try:
+        sender, email_subject, email_body_text = render_content(contact_dict)
+        if checked_recipients is None:
+            recipients = parse_recipients(recipients_string)
+        email = RenderedEmail(sender, recipients, email_subject, email_body_text, contact_attachment_files_for(contact_dict))
+        email_size = email.estimated_size() if max_message_size else 0
+        if email_size > max_message_size:
+            # Failed before sending, rather than by the relay after the whole message was transferred
+            contact_dict['sendmail_status'] = 'FAILED'
+            contact_dict['sendmail_error'] = f"Email of about {email_size} bytes is over the maximum message size of {max_message_size} bytes"
+            return contact_dict, None
+        return contact_dict, email
+    except Exception as e:
+        logging.exception("Send failed")
+        contact_dict['sendmail_status'] = 'FAILED'
+        contact_dict['sendmail_error'] = str(e)
+        return contact_dict, None
+
+
+def filter_recipients(rendered_contact):
+    """
+    Leave out of the email rendered by render_contact the recipients that already got it: from a previous row (duplicate filter)
+    or a previous run (journal). Must be called on the rows in input order, so the first of identical rows is the one sending.
+    """
+    contact_dict, email = rendered_contact
+    if email is None:
+        return rendered_contact
+    if duplicate_filter:
+        attachment_key = contact_dict.get(attachment_contact_key_column) if partitioned_attachments else None
+        email.recipients = duplicate_filter.claim_row(contact_dict, email.recipients, (email.sender, email.subject, email.body, attachment_key))
+        if not email.recipients:
+            contact_dict['sendmail_status'] = 'SKIPPED'
+            contact_dict['sendmail_error'] = "Same email already sent to the same recipient(s) by a previous row"
+            return contact_dict, None
+    if journal:
+        # Recipients already delivered by a previous run are skipped
+        email.recipients = [r for r in email.recipients if not journal.is_delivered(contact_dict[ROW_KEY_COLUMN], r)]
+    return contact_dict, email
+
+
+def send_rendered(rendered_contact):
+    """ Send the email rendered by render_contact, returns the contact_dict with the sendmail status columns set """
+    contact_dict, email = rendered_contact
+    if email is None:
+        return contact_dict
+    start = time.perf_counter()
+    send_rendered_email(contact_dict, email)
+    if metrics_per_row:
+        add_row_duration(contact_dict, start)
+    return contact_dict
+
+
+def send_rendered_email(contact_dict, email):
+    try:
+        if dry_run:
+            contact_dict['sendmail_size_bytes'] = email_client.message_size(email.sender, email.recipients, email.subject, email.body,
+                                                                            email.attachment_files)
+            contact_dict['sendmail_status'] = 'DRY_RUN'
+            return
+        if journal:
+            # One recipient at a time, so each delivery is recorded as soon as it is done
+            for recipient in email.recipients:
+                email_client.send_email(email.sender, [recipient], email.subject, email.body, email.attachment_files)
+                journal.record_delivery(contact_dict[ROW_KEY_COLUMN], recipient)
+        else:
+            email_client.send_email(email.sender, email.recipients, email.subject, email.body, email.attachment_files)
+        contact_dict['sendmail_status'] = 'SUCCESS'
+    except Exception as e:
+        logging.exception("Send failed")
+        contact_dict['sendmail_status'] = 'FAILED'
+        contact_dict['sendmail_error'] = str(e)
+
+
+def submit_rendered(rendered_contact):
+    """ Asyncio client - start sending the email rendered by render_contact, returns what finish_rendered needs to wait for it """
+    contact_dict, email = rendered_contact
+    if email is None:
+        return None
+    # One recipient at a time with the journal, so each delivery is recorded on its own
+    recipient_groups = [[recipient] for recipient in email.recipients] if journal else [email.recipients]
+    return time.perf_counter(), [(recipients, email_client.submit_email(email.sender, recipients, email.subject, email.body, email.attachment_files))
+                                 for recipients in recipient_groups]
+
+
+def finish_rendered(rendered_contact, submitted):
+    """ Asyncio client - wait for the sends started by submit_rendered, returns the contact_dict with the sendmail status columns set """
+    contact_dict, email = rendered_contact
+    if submitted is None:
+        return contact_dict
+    start, sends = submitted
+    errors = []
+    for recipients, future in sends:
+        try:
+            future.result()
+            if journal:
+                journal.record_delivery(contact_dict[ROW_KEY_COLUMN], recipients[0])
+        except Exception as e:
+            logging.exception("Send failed")
+            errors.append(str(e))
+    if errors:
+        contact_dict['sendmail_status'] = 'FAILED'
+        contact_dict['sendmail_error'] = errors[0]
+    else:
+        contact_dict['sendmail_status'] = 'SUCCESS'
+    if metrics_per_row:
+        add_row_duration(contact_dict, start)
+    return contact_dict
+
+
+def send_to_contact(contact_dict):
+    return send_rendered(filter_recipients(render_contact(contact_dict)))
+
+
+def with_checked_recipients(contact_dicts):
+    """ Attach to each contact dict the (valid, invalid) addresses found by the recipient check of its row """
+    for contact_dict in contact_dicts:
+        contact_dict[CHECKED_RECIPIENTS_KEY] = check_recipients(contact_dict[recipient_column])
+        yield contact_dict
+
+
+def send_in_windows(contact_dicts):
+    """ Batched mode - render a window of rows, send identical emails together, then yield the rows in input order """
+    window = []
+    for contact_dict in contact_dicts:
+        window.append(contact_dict)
+        if len(window) >= batch_window_size:
+            yield from send_window(window)
+            window = []
+    if window:
+        yield from send_window(window)
+
+
+def send_window(window):
+    rendered_contacts = [filter_recipients(render_contact(contact_dict)) for contact_dict in window]
+    start = time.perf_counter()
+    send_in_batches(email_client, rendered_contacts, channel_batch_size, journal)
+    if metrics_per_row:
+        # The sending time of the window is shared between its rows
+        send_duration_ms = 1000 * (time.perf_counter() - start) / len(rendered_contacts)
+        for contact_dict, email in rendered_contacts:
+            if email is not None:
+                contact_dict['sendmail_duration_ms'] = contact_dict.get('sendmail_duration_ms', 0.0) + send_duration_ms
+    return [contact_dict for contact_dict, _ in rendered_contacts]
+
+
+def process_contacts(contact_dicts):
+    """ Render and send the emails of a stream of contacts, yields the contact dicts with their sendmail status in input order """
+    pipeline = None
+    if use_batching:
+        # Identical emails of a window of rows are grouped into as few channel calls as possible
+        results = send_in_windows(contact_dicts)
+    elif use_async_smtp:
+        # Emails are sent by the event loop of the client, while the following rows are rendered
+        rendered_contacts = map(filter_recipients, ordered_map(render_contact, contact_dicts, render_workers if use_pipeline else 1))
+        results = ordered_submit(submit_rendered, finish_rendered, rendered_contacts, smtp_max_in_flight)
+    elif use_pipeline:
+        # Reading, rendering, sending and writing all run at the same time, results still come back in input order
+        pipeline = Pipeline([PipelineStage("render", render_contact, render_workers),
+                             PipelineStage("recipients", filter_recipients, ordered=True),
+                             PipelineStage("send", send_rendered, send_workers)],
+                            queue_size=pipeline_queue_size)
+        results = pipeline.run(contact_dicts)
+    elif duplicate_filter:
+        # Rendered by a pool of workers, but recipients are filtered in input order before the rows are sent
+        rendered_contacts = map(filter_recipients, ordered_map(render_contact, contact_dicts, send_workers))
+        results = ordered_map(send_rendered, rendered_contacts, send_workers)
+    else:
+        # Rows are sent by a pool of workers (one per SMTP connection) but results come back in input order
+        results = ordered_map(send_to_contact, contact_dicts, send_workers)
+    if duplicate_filter:
+        results = duplicate_filter.settle_rows(results, lambda contact_dict, recipient: bool(
+            journal and journal.is_delivered(contact_dict[ROW_KEY_COLUMN], recipient)))
+    yield from results
+    if pipeline:
+        pipeline.log_summary()
+
+
+def log_process_summary():
+    if duplicate_filter:
+        duplicate_filter.log_summary()
+    for template_name, template in [("Subject", subject_template), ("Body", body_template)]:
+        if template and not template.is_static():
+            logging.info(f"{template_name} template: {template.cache_hits} renders reused from the cache")
+
+
+def time_relay_sample():
+    """
+    Dry run - send the emails of the first rows to dry_run_sample_recipient through the real relay (or channel), as the actual
+    run would send them (same client, connections and rate limit)
+    :returns: tuple (number of emails sent, seconds taken)
+    """
+    sample_emails = []
+    for contact_dict in itertools.islice(contact_reader.iter_contacts(), dry_run_sample_size):
+        try:
+            sender, email_subject, email_body_text = render_content(contact_dict)
+            sample_emails.append(RenderedEmail(sender, [dry_run_sample_recipient], email_subject, email_body_text,
+                                               contact_attachment_files_for(contact_dict)))
+        except Exception as e:
+            logging.info(f"Row left out of the relay sample, it cannot be rendered: {e}")
+    relay_client = create_email_client(null_transport=False)
+    relay_client.login()
+    try:
+        start = time.perf_counter()
+        if is_direct_smtp and smtp_use_asyncio:
+            # Up to smtp_max_in_flight emails pipelined, as process_contacts sends them with the asyncio client
+            sent = ordered_submit(lambda email: relay_client.submit_email(email.sender, email.recipients, email.subject, email.body,
+                                                                          email.attachment_files),
+                                  lambda email, future: future.result(), sample_emails, smtp_max_in_flight)
+        else:
+            sent = ordered_map(lambda email: relay_client.send_email(email.sender, email.recipients, email.subject, email.body,
+                                                                     email.attachment_files),
+                               sample_emails, send_workers)
+        for _ in sent:
+            pass
+        return len(sample_emails), time.perf_counter() - start
+    finally:
+        relay_client.quit()
+
+
+def log_dry_run_projection(dry_run_seconds):
+    """ Dry run - log the size of the emails and the projected duration of the actual run, also written to the metrics """
+    messages = METRICS.counter("dry_run_messages")
+    message_bytes = METRICS.counter("dry_run_bytes")
+    logging.info(f"Dry run: {messages} emails built in {dry_run_seconds:.1f}s, {message_bytes} bytes to send")
+    if not dry_run_sample_recipient or not dry_run_sample_size:
+        logging.info("No sample recipient, the sending time is not projected")
+        return
+    try:
+        sent, sample_seconds = time_relay_sample()
+    except Exception:
+        logging.exception("Relay sample failed, the sending time is not projected")
+        return
+    if not sent:
+        return
+    # Each sending process has its own connections
+    send_rate = send_processes * sent / max(sample_seconds, 1e-6)
+    projected_send_seconds = messages / send_rate
+    # Upper bound - rendering and sending overlap when several workers are used
+    projected_run_seconds = dry_run_seconds + projected_send_seconds
+    logging.info(f"Relay sample: {sent} emails sent to {dry_run_sample_recipient} in {sample_seconds:.2f}s - projected run: "
+                 f"about {projected_run_seconds:.0f}s, of which {projected_send_seconds:.0f}s sending at {send_rate:.1f} emails/s")
+    METRICS.increment("dry_run_sample_messages", sent)
+    METRICS.increment("projected_send_seconds", round(projected_send_seconds))
+    METRICS.increment("projected_run_seconds", round(projected_run_seconds))
+
+
+def start_sending_process():
+    """ Run at the start of each process of the sharded mode """
+    global email_client
+    # Timings are sent back to the main process at the end, only those of this process must be counted
+    METRICS.reset()
+    if journal:
+        journal.reopen_after_fork()
+    email_client = create_email_client()
+    email_client.login()
+
+
+def stop_sending_process():
+    """ Run at the end of each process of the sharded mode, returns its metrics to be merged in the main process """
+    email_client.quit()
+    if journal:
+        journal.sync()
+    log_process_summary()
+    return METRICS.snapshot()
+
+
+run_start = time.perf_counter()
 with output.get_writer() as writer:
+    batched_writer = BatchedWriter(writer, output_column_names, output_batch_size, output_flush_interval)
     i = 0
     success = 0
     fail = 0
+    skipped = 0
+    resumed = 0
     try:
-        for contact in people.iter_rows():
-            recipients_string = contact[recipient_column]
-            if recipients_string:
-                logging.info("Sending to %s" % recipients_string)
-            else:
-                logging.info("No recipient for row - emailing will fail - row data: %s" % contact)
-            contact_dict = dict(contact)
-            try:
-                email_subject = build_email_subject(use_subject_value, subject_template, subject_column, contact_dict)
-                email_body_text = build_email_message_text(use_body_value, body_template, attachments_templating_dict, contact_dict, body_column,
-                                                         use_html_body_value)
-                recipients = parse_recipients(recipients_string)
-                # Note - if the channel has a sender configured, the sender value will be ignored by the email client here
-                sender = sender_value if use_sender_value else contact_dict.get(sender_column, "")
-                email_client.send_email(sender, recipients, email_subject, email_body_text, attachment_files)
-
-                contact_dict['sendmail_status'] = 'SUCCESS'
+        contact_dicts = timed_iter(contact_reader.iter_contacts(), "read_row")
+        if journal:
+            contact_dicts = with_row_keys(contact_dicts, journal_key_column)
+        if validate_recipients:
+            # Checked as the rows are read, before they are dispatched to the rendering and sending workers
+            contact_dicts = with_checked_recipients(contact_dicts)
+        if send_processes > 1:
+            shard_key = (lambda contact_dict: contact_dict.get(recipient_column)) if shard_by == 'recipient' else None
+            sharded_runner = ShardedRunner(process_contacts, send_processes, shard_key, start_sending_process, stop_sending_process)
+            results = sharded_runner.run(contact_dicts)
+        else:
+            sharded_runner = None
+            results = process_contacts(contact_dicts)
+        for contact_dict in results:
+            if contact_dict['sendmail_status'] in ('SUCCESS', 'DRY_RUN'):
                 success += 1
-                if writer:
-                    writer.write_row_dict(contact_dict)
-            except Exception as e:
-                logging.exception("Send failed")
+            elif contact_dict['sendmail_status'] == 'SKIPPED':
+                skipped += 1
+            else:
                 fail += 1
-                contact_dict['sendmail_status'] = 'FAILED'
-                contact_dict['sendmail_error'] = str(e)
-                if writer:
-                    writer.write_row_dict(contact_dict)
+            METRICS.increment("rows_" + contact_dict['sendmail_status'].lower())
+            output_values = contact_reader.output_values(contact_dict, extra_output_columns)
+            if slim_output:
+                output_values.insert(0, i)
+            if journal:
+                if journal.completed_row(contact_dict[ROW_KEY_COLUMN]) is not None:
+                    resumed += 1
+                else:
+                    journal.record_row(contact_dict[ROW_KEY_COLUMN], dict(zip(output_column_names, output_values)))
+            batched_writer.write(output_values)
             i += 1
             if i % 5 == 0:
-                logging.info("Sent %d mails (%d success %d fail)" % (i, success, fail))
+                logging.info("Sent %d mails (%d success %d fail %d skipped)" % (i, success, fail, skipped))
     except RuntimeError as runtime_error:
         # https://stackoverflow.com/questions/51700960/runtimeerror-generator-raised-stopiteration-every-time-i-try-to-run-app
         logging.info("Exception {}".format(runtime_error))
-email_client.quit()
+    finally:
+        # Rows already processed are written even if the run fails
+        batched_writer.flush()
+    if journal:
+        journal.close()
+        logging.info(f"{resumed} rows were already sent by a previous run, their output was taken from the journal")
+    if sharded_runner:
+        for process_metrics in sharded_runner.finalizer_results:
+            METRICS.merge(process_metrics)
+    else:
+        log_process_summary()
+if email_client:
+    email_client.quit()
+if dry_run:
+    log_dry_run_projection(time.perf_counter() - run_start)
+
+METRICS.log_summary()
+if metrics_output:
+    metrics_output.write_schema(METRICS_SCHEMA)
+    with metrics_output.get_writer() as metrics_writer:
+        for record in METRICS.summary_records():
+            metrics_writer.write_row_dict(record)
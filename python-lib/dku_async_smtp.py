@@ -0,0 +1,279 @@
+# Asyncio SMTP connection, pipelining the commands of a mail transaction (RFC 2920) when the server advertises it
+import asyncio
+import base64
+import smtplib
+import ssl
+from collections import deque
+from dku_spooled_buffer import CHUNK_SIZE
+
+# Seconds waited for a reply of the server before the connection is considered dead
+SMTP_REPLY_TIMEOUT = 300.0
+
+
+def starttls_context():
+    """
+    :returns: ssl.SSLContext of STARTTLS, shared by both SMTP clients - as smtplib.SMTP.starttls without a context, the certificate of the
+              server is not verified, so relays with internal or self-signed certificates keep working
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def envelope_bytes(sender, recipients):
+    """ :returns: bytes, the MAIL FROM, RCPT TO and DATA commands of a message, written at once when the server supports pipelining """
+    return "".join([f"mail FROM:{smtplib.quoteaddr(sender)}\r\n"] +
+                   [f"rcpt TO:{smtplib.quoteaddr(recipient)}\r\n" for recipient in recipients] +
+                   ["data\r\n"]).encode("ascii")
+
+
+class SmtpProtocol(asyncio.Protocol):
+    """ Buffers the bytes received from the server into complete (multi-line) replies, and handles write flow control """
+    def __init__(self):
+        self.transport = None
+        self.buffer = bytearray()
+        self.reply_lines = []
+        # Complete replies not read yet - with pipelining, the server answers several commands at once
+        self.replies = deque()
+        self.reply_waiter = None
+        self.lost = False
+        self.paused = False
+        self.drain_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while True:
+            end = self.buffer.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(self.buffer[:end + 1]).rstrip(b"\r\n")
+            del self.buffer[:end + 1]
+            self.reply_lines.append(line[4:].strip())
+            # "250-" continues the reply, "250 " ends it
+            if line[3:4] != b"-":
+                code = line[:3]
+                self.replies.append((int(code) if code.isdigit() else -1, b"\n".join(self.reply_lines)))
+                self.reply_lines = []
+        if self.replies:
+            self.wake(self.reply_waiter)
+
+    def connection_lost(self, exc):
+        self.lost = True
+        self.wake(self.reply_waiter)
+        self.wake(self.drain_waiter)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.wake(self.drain_waiter)
+
+    @staticmethod
+    def wake(waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def read_reply(self):
+        """ :returns: tuple (code, message) of the next reply of the server, as smtplib.SMTP.getreply """
+        while not self.replies:
+            if self.lost:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            self.reply_waiter = asyncio.get_event_loop().create_future()
+            try:
+                await asyncio.wait_for(self.reply_waiter, SMTP_REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.transport.abort()
+                raise smtplib.SMTPServerDisconnected(f"No reply from the server in {SMTP_REPLY_TIMEOUT:.0f}s")
+        return self.replies.popleft()
+
+    async def drain(self):
+        """ Wait until the transport write buffer is small enough, so a large message is not entirely buffered in memory """
+        while self.paused and not self.lost:
+            self.drain_waiter = asyncio.get_event_loop().create_future()
+            await self.drain_waiter
+        if self.lost:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+
+class AsyncSmtpConnection:
+    """
+    One SMTP session, used by a single coroutine at a time
+    :param smtp_config: SmtpConfig
+    :param local_hostname: str, name sent in EHLO
+    """
+    def __init__(self, smtp_config, local_hostname):
+        self.smtp_config = smtp_config
+        self.local_hostname = local_hostname
+        self.protocol = None
+        self.extensions = {}
+        self.messages_sent = 0
+
+    @property
+    def pipelining(self):
+        return "pipelining" in self.extensions
+
+    def is_open(self):
+        return self.protocol is not None and not self.protocol.lost
+
+    def write(self, data):
+        if self.protocol.lost:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.protocol.transport.write(data)
+
+    async def command(self, line):
+        """ Send a command and wait for its reply :returns: tuple (code, message) """
+        self.write(line.encode("ascii") + b"\r\n")
+        return await self.protocol.read_reply()
+
+    async def open(self):
+        """ Connect, start TLS and authenticate as configured """
+        loop = asyncio.get_event_loop()
+        _, self.protocol = await loop.create_connection(SmtpProtocol, self.smtp_config.smtp_host, self.smtp_config.smtp_port)
+        code, message = await self.protocol.read_reply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, message)
+        await self.ehlo()
+        if self.smtp_config.smtp_use_tls:
+            await self.starttls()
+        if self.smtp_config.smtp_use_auth:
+            await self.login(str(self.smtp_config.smtp_user), str(self.smtp_config.smtp_pass))
+
+    async def ehlo(self):
+        code, message = await self.command(f"ehlo {self.local_hostname}")
+        self.extensions = {}
+        if code != 250:
+            # Server without ESMTP support - no pipelining
+            code, message = await self.command(f"helo {self.local_hostname}")
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+            return
+        for line in message.decode("latin-1").split("\n")[1:]:
+            keyword, _, params = line.partition(" ")
+            self.extensions[keyword.lower()] = params.strip()
+
+    async def starttls(self):
+        if "starttls" not in self.extensions:
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        code, message = await self.command("STARTTLS")
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, message)
+        loop = asyncio.get_event_loop()
+        if not hasattr(loop, "start_tls"):
+            raise Exception("The asyncio SMTP client needs Python 3.7 or later to use TLS")
+        self.protocol.transport = await loop.start_tls(self.protocol.transport, self.protocol, starttls_context(),
+                                                       server_hostname=self.smtp_config.smtp_host)
+        # Extensions must be asked again over TLS (RFC 3207)
+        await self.ehlo()
+
+    async def login(self, user, password):
+        mechanisms = self.extensions.get("auth", "").upper().split()
+        if "PLAIN" in mechanisms:
+            token = base64.b64encode(f"\0{user}\0{password}".encode("utf-8")).decode("ascii")
+            code, message = await self.command(f"AUTH PLAIN {token}")
+        elif "LOGIN" in mechanisms:
+            code, message = await self.command(f"AUTH LOGIN {base64.b64encode(user.encode('utf-8')).decode('ascii')}")
+            if code == 334:
+                code, message = await self.command(base64.b64encode(password.encode("utf-8")).decode("ascii"))
+        else:
+            raise smtplib.SMTPException("No suitable authentication method found.")
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    async def read_envelope_replies(self, sender, recipients):
+        """
+        Read the replies to an envelope written at once, as returned by envelope_bytes
+        :returns: dict of refused recipients
+        :raises: the smtplib exception sendmail raises for the same replies, the transaction is then reset
+        """
+        mail_reply = await self.protocol.read_reply()
+        rcpt_replies = [await self.protocol.read_reply() for _ in recipients]
+        data_reply = await self.protocol.read_reply()
+        if mail_reply[0] != 250:
+            await self.failed_transaction(mail_reply[0], data_reply[0] == 354)
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], sender)
+        refused = {recipient: reply for recipient, reply in zip(recipients, rcpt_replies) if reply[0] not in (250, 251)}
+        if len(refused) == len(recipients):
+            await self.failed_transaction(421 if data_reply[0] == 421 else 0, data_reply[0] == 354)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_reply[0] != 354:
+            await self.failed_transaction(data_reply[0], False)
+            raise smtplib.SMTPDataError(*data_reply)
+        return refused
+
+    async def send_envelope(self, sender, recipients):
+        """ Send the envelope one command at a time, for servers without pipelining :returns: dict of refused recipients """
+        code, message = await self.command(f"mail FROM:{smtplib.quoteaddr(sender)}")
+        if code != 250:
+            await self.failed_transaction(code, False)
+            raise smtplib.SMTPSenderRefused(code, message, sender)
+        refused = {}
+        for recipient in recipients:
+            code, message = await self.command(f"rcpt TO:{smtplib.quoteaddr(recipient)}")
+            if code not in (250, 251):
+                refused[recipient] = (code, message)
+            if code == 421:
+                self.close()
+                raise smtplib.SMTPRecipientsRefused(refused)
+        if len(refused) == len(recipients):
+            await self.failed_transaction(0, False)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, message = await self.command("data")
+        if code != 354:
+            await self.failed_transaction(code, False)
+            raise smtplib.SMTPDataError(code, message)
+        return refused
+
+    async def failed_transaction(self, code, data_accepted):
+        """ Leave the connection ready for the next transaction after a refused envelope, as smtplib does """
+        if code == 421:
+            self.close()
+            return
+        if data_accepted:
+            # The server accepted DATA despite the failed commands: send an empty message to end it (RFC 2920)
+            self.write(b".\r\n")
+            await self.protocol.read_reply()
+        code, _ = await self.command("rset")
+        if code != 250:
+            self.close()
+
+    async def write_content(self, message_chunks):
+        """ Stream the message, already in SMTP wire format, followed by the end of data marker """
+        # Small chunks (headers, boundaries) are coalesced into larger writes
+        pending = bytearray()
+        last_bytes = b""
+        for chunk in message_chunks:
+            pending += chunk
+            last_bytes = (last_bytes + chunk[-2:])[-2:]
+            if len(pending) >= CHUNK_SIZE:
+                self.write(bytes(pending))
+                pending.clear()
+                await self.protocol.drain()
+        if last_bytes != b"\r\n":
+            pending += b"\r\n"
+        pending += b".\r\n"
+        self.write(bytes(pending))
+
+    async def read_data_reply(self):
+        code, message = await self.protocol.read_reply()
+        if code != 250:
+            if code == 421:
+                self.close()
+            raise smtplib.SMTPDataError(code, message)
+
+    async def quit(self):
+        if self.is_open():
+            try:
+                await self.command("quit")
+            finally:
+                self.close()
+
+    def close(self):
+        if self.protocol is not None and self.protocol.transport is not None:
+            self.protocol.transport.close()
+            self.protocol.lost = True
@@ -0,0 +1,58 @@
+# Local disk cache of the attachment exports, so that runs on unchanged attachment datasets do not export them again
+import hashlib
+import json
+import logging
+import os
+import threading
+from dku_spooled_buffer import spool_stream
+
+
+class AttachmentExportCache:
+    """
+    Exports of attachment datasets kept in a local folder between runs, keyed by dataset version and export format.
+    Only the latest export of each dataset is kept.
+    :param cache_dir: str, path of the folder on the DSS server filesystem, created if needed
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, dataset_name, version, request_fmt, format_params):
+        """ :returns: tuple (prefix shared by all the exports of the dataset, path of the export of this version and format) """
+        prefix = hashlib.sha256(dataset_name.encode("utf-8")).hexdigest()[:16]
+        key = hashlib.sha256(json.dumps([version, request_fmt, format_params], sort_keys=True).encode("utf-8")).hexdigest()[:32]
+        return prefix, os.path.join(self.cache_dir, f"{prefix}-{key}.export")
+
+    def get(self, dataset_name, version, request_fmt, format_params):
+        """ :returns: SpooledBuffer with the cached export, None if there is none """
+        _, path = self.entry_path(dataset_name, version, request_fmt, format_params)
+        try:
+            with open(path, "rb") as cached_file:
+                return spool_stream(cached_file)
+        except FileNotFoundError:
+            return None
+
+    def put(self, dataset_name, version, request_fmt, format_params, data):
+        """
+        Store an export, replacing the previous exports of the dataset - errors are logged, the cache is only an optimisation
+        :param data: SpooledBuffer
+        """
+        prefix, path = self.entry_path(dataset_name, version, request_fmt, format_params)
+        # Written under a temporary name then renamed, so that a concurrent run never reads a partial export
+        temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as cached_file:
+                for chunk in data.iter_chunks():
+                    cached_file.write(chunk)
+            os.replace(temp_path, path)
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.startswith(prefix + "-") and file_name.endswith(".export") and os.path.join(self.cache_dir, file_name) != path:
+                    try:
+                        os.remove(os.path.join(self.cache_dir, file_name))
+                    except FileNotFoundError:
+                        # Removed by another run meanwhile
+                        pass
+        except OSError as e:
+            logging.warning(f"Could not cache the export of attachment {dataset_name}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
@@ -1,53 +1,217 @@
-from dku_email_client import AttachmentFile
-from dku_support_detection import supports_dataset_to_html, supports_messaging_channels_and_conditional_formatting
+from dku_email_client import AttachmentFile, base64_encoded_size
+from dku_spooled_buffer import spool_stream
+from dku_compression import COMPRESSIONS, compress_chunks, compress_stream
+from dku_metrics import timed
+from dku_support_detection import supports_dataset_to_html
+from dku_dss_api import supports_messaging_channels, get_dataset_data_version
+import io
 import logging
-import dataiku
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+import pandas as pd
 
 
-def attachments_template_dict(attachment_datasets, home_project_key, apply_coloring):
+class LazyAttachmentEntry(Mapping):
+    """
+    Templating data of one attachment dataset, a mapping with keys `html_table` and `data`.
+    Each value is only computed (with calls to DSS) the first time a template accesses it, then kept for the rest of the run.
+    Both values come from the same read of the dataset, unless the HTML table is coloured by DSS.
+    :param attachment_ds: DSS dataset
+    :param apply_coloring: whether to apply colouring configured in explore view to the HTML table
+    :param preview_rows: int, number of rows of the dataset included
+    """
+    KEYS = ("html_table", "data")
+
+    def __init__(self, attachment_ds, apply_coloring, preview_rows):
+        self.attachment_ds = attachment_ds
+        self.apply_coloring = apply_coloring
+        self.preview_rows = preview_rows
+        self.computed_values = {}
+        self.table_df = None
+        # Several rendering and prefetching threads may access the same entry - each value is computed by a single one
+        self.locks = {key: threading.Lock() for key in self.KEYS}
+        self.table_df_lock = threading.Lock()
+
+    def uses_dss_html(self):
+        # DSS to_html method (DSS 12.6.2+) is only needed to apply the colouring
+        return self.apply_coloring and supports_dataset_to_html(self.attachment_ds)
+
+    def get_table_df(self):
+        with self.table_df_lock:
+            if self.table_df is None:
+                logging.info(f"Reading templating data of attachment {self.attachment_ds.full_name} ({self.preview_rows} rows)")
+                self.table_df = self.attachment_ds.get_dataframe(limit=self.preview_rows)
+            return self.table_df
+
+    def compute(self, key):
+        if key == "html_table":
+            if self.uses_dss_html():
+                logging.info(f"Reading coloured HTML table of attachment {self.attachment_ds.full_name} ({self.preview_rows} rows)")
+                return self.attachment_ds.to_html(limit=self.preview_rows, border=0, null_string="", apply_conditional_formatting=True)
+            return self.get_table_df().to_html(index=False, justify='left', border=0, na_rep="")
+        return self.get_table_df().to_dict('records')
+
+    def prefetch(self, executor):
+        """
+        Start the read of the dataset in the background, so it is done by the time a template accesses the values
+        :param executor: concurrent.futures.Executor
+        """
+        if self.uses_dss_html():
+            # The HTML table is the value most likely used, data is only read if a template accesses it
+            executor.submit(self.__getitem__, "html_table")
+        else:
+            executor.submit(self.get_table_df)
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        with self.locks[key]:
+            if key not in self.computed_values:
+                self.computed_values[key] = self.compute(key)
+            return self.computed_values[key]
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def attachments_template_dict(attachment_datasets, home_project_key, apply_coloring, preview_rows=50, executor=None):
     """
      :param attachment_datasets: List of attachment datasets (DSS datasets)
      :param home_project_key: key of the project we are in
      :param apply_coloring: whether to apply colouring configured in explore view to the HTML tables
-     :return dictionary of attachment dataset nams each to a dict containing keys `html_table` and `data`,
+     :param preview_rows: int, number of rows of each dataset included
+     :param executor: concurrent.futures.Executor reading the datasets in the background, None to only read them when accessed
+     :return dictionary of attachment dataset nams each to a LazyAttachmentEntry mapping containing keys `html_table` and `data`,
              where `data` is a list of records, each a dictionary of column names to values,
              and `html_table` is a string of html for the table with css class `dataframe`
-             Only the first 50 rows are included.
+             Only the first preview_rows rows are included, and without an executor nothing is read from DSS until a template
+             accesses the values.
     """
 
     attachments_dict = {}
     for attachment_ds in attachment_datasets:
-        table_df = attachment_ds.get_dataframe(limit=50)
         ds_name = attachment_ds.full_name.split(".")[1]
         if attachment_ds.project_key == home_project_key:
-            attachment_entry = attachments_dict.setdefault(ds_name, {})
+            entries = attachments_dict
         else:
             # For foreign datasets, we need another level in the map with the project key
-            ext_project_entry = attachments_dict.setdefault(attachment_ds.project_key, {})
-            attachment_entry = ext_project_entry.setdefault(ds_name, {})
-
-        # Use DSS to_html method if available (DSS 12.6.2+)
-        if supports_dataset_to_html(attachment_ds):
-            attachment_entry["html_table"] = attachment_ds.to_html(limit=50, border=0, null_string="", apply_conditional_formatting=apply_coloring)
-        else:
-            attachment_entry["html_table"] = table_df.to_html(index=False, justify='left', border=0, na_rep="")
-        attachment_entry["data"] = table_df.to_dict('records')
+            entries = attachments_dict.setdefault(attachment_ds.project_key, {})
+        entries[ds_name] = LazyAttachmentEntry(attachment_ds, apply_coloring, preview_rows)
+        if executor:
+            entries[ds_name].prefetch(executor)
 
     return attachments_dict
 
 
-def build_attachment_files(attachment_datasets, attachment_type, apply_coloring_excel):
+# Compression used when attachments are too large for the maximum message size and no compression was chosen
+AUTO_COMPRESSION = "zip"
+
+
+def dataset_file_type(attachment_ds, is_excel):
+    """ :returns: tuple (file name, mime type, mime subtype) of the export of an attachment dataset """
+    if is_excel:
+        return attachment_ds.full_name + ".xlsx", "application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    return attachment_ds.full_name + ".csv", "text", "csv"
+
+
+def dataset_attachment_file(attachment_ds, is_excel, file_bytes, compression=None):
+    """
+    :param file_bytes: bytes or SpooledBuffer, the export of the dataset - compressed if compression is set
+    :param compression: str, key of COMPRESSIONS, None if the export is not compressed
+    :returns: AttachmentFile named after the dataset
+    """
+    file_name, mime_type, mime_subtype = dataset_file_type(attachment_ds, is_excel)
+    if compression:
+        extension, compressed_mime_subtype = COMPRESSIONS[compression]
+        return AttachmentFile(file_name + extension, "application", compressed_mime_subtype, file_bytes)
+    return AttachmentFile(file_name, mime_type, mime_subtype, file_bytes)
+
+
+def compress_attachment(attachment_file, compression):
+    """ :returns: AttachmentFile, the compressed attachment file - named after the original one, with the extension of the compression """
+    extension, mime_subtype = COMPRESSIONS[compression]
+    compressed = compress_chunks(attachment_file.content.iter_chunks(), attachment_file.file_name, compression)
+    return AttachmentFile(attachment_file.file_name + extension, "application", mime_subtype, compressed)
+
+
+def fit_message_size(attachment_files, compression, max_message_size):
+    """
+    Check the attachments fit in the maximum message size once base64 encoded, compressing them if they do not and no compression
+    was chosen - so that emails over the limit of the SMTP relay are not even tried
+    :param compression: str, compression of the attachments, None if they are not compressed
+    :param max_message_size: int, bytes
+    :returns: list of AttachmentFile, compressed if needed
+    :raises: Exception if the attachments do not fit even compressed
+    """
+    encoded_size = sum(base64_encoded_size(attachment_file.size) for attachment_file in attachment_files)
+    if encoded_size > max_message_size and not compression:
+        logging.info(f"Attachments are {encoded_size} bytes once encoded, over the maximum message size of {max_message_size} bytes "
+                     f"- compressing them with {AUTO_COMPRESSION}")
+        attachment_files = [compress_attachment(attachment_file, AUTO_COMPRESSION) for attachment_file in attachment_files]
+        encoded_size = sum(base64_encoded_size(attachment_file.size) for attachment_file in attachment_files)
+        compression = AUTO_COMPRESSION
+    if encoded_size > max_message_size:
+        raise Exception(f"Attachments are {encoded_size} bytes once encoded ({compression} compressed), "
+                        f"over the maximum message size of {max_message_size} bytes")
+    return attachment_files
+
+
+def export_attachment(attachment_ds, request_fmt, format_params, export_cache, compression=None, file_name=None):
+    """
+    :param export_cache: AttachmentExportCache, None for no cache
+    :param compression: str, key of COMPRESSIONS to compress the export while it is read, None to keep it as is
+    :param file_name: str, name of the file within the compressed archive
+    :returns: SpooledBuffer holding the export of the dataset in the requested format
+    """
+    # Compressed and plain exports are cached separately
+    cache_format = f"{request_fmt}+{compression}" if compression else request_fmt
+    version = get_dataset_data_version(attachment_ds.full_name) if export_cache else None
+    if version:
+        file_bytes = export_cache.get(attachment_ds.full_name, version, cache_format, format_params)
+        if file_bytes is not None:
+            logging.info(f"Attachment {attachment_ds.full_name} unchanged since its cached export: {file_bytes.size} bytes")
+            return file_bytes
+    # Stream the export to a buffer that spills to disk, so large datasets are never held in memory in full
+    with attachment_ds.raw_formatted_data(format=request_fmt, format_params=format_params) as stream:
+        if compression:
+            file_bytes = compress_stream(stream, file_name, compression)
+        else:
+            file_bytes = spool_stream(stream)
+    logging.info(f"Exported attachment {attachment_ds.full_name}{f' ({compression} compressed)' if compression else ''}: {file_bytes.size} bytes, "
+                 f"peak memory buffer {file_bytes.peak_memory_size} bytes "
+                 f"({'in memory' if file_bytes.is_in_memory() else 'spooled to disk'})")
+    if version:
+        export_cache.put(attachment_ds.full_name, version, cache_format, format_params, file_bytes)
+    elif export_cache:
+        logging.info(f"Attachment {attachment_ds.full_name} has no known version (e.g. not built by DSS), its export is not cached")
+    return file_bytes
+
+
+@timed("export_attachments")
+def build_attachment_files(attachment_datasets, attachment_type, apply_coloring_excel, executor=None, export_cache=None,
+                           compression=None, max_message_size=0):
     """
         :param attachment_datasets: List of attachment datasets
         :param attachment_type: str, e.g. "excel", "csv" - "excel_can_ac" is treated as excel, "send_no_attachments" means none
         :param apply_coloring_excel: boolean, whether to apply conditional formatting (aka coloring) for Excel attachments
+        :param executor: concurrent.futures.Executor running the exports at the same time, None to run them one after another
+        :param export_cache: AttachmentExportCache, None to always export the datasets
+        :param compression: str, key of COMPRESSIONS to send compressed attachments, None to send them as is
+        :param max_message_size: int, bytes - the attachments are compressed if they do not fit, 0 for no limit
         :return: Attachments as List of AttachmentFile
     """
 
     if "send_no_attachments" == attachment_type:
         return []
 
-    logging.info(f"Building attachments, type: {attachment_type}, apply colouring? {apply_coloring_excel}")
+    logging.info(f"Building attachments, type: {attachment_type}, apply colouring? {apply_coloring_excel}, compression: {compression}")
 
     # "excel_can_ac" was used to indicate excel in version 1.0.0 of the plugin - but it caused migration problems, so we got rid of it (see SC 80121)
     # Still, if the config has "excel_can_ac" and is run from the flow, we want to treat as excel (it means the user saved in v1.0.0 and did not reopen it)
@@ -56,19 +220,127 @@ def build_attachment_files(attachment_datasets, attachment_type, apply_coloring_
     format_params = None
     if is_excel:
         request_fmt = "excel"
-        if apply_coloring_excel and supports_messaging_channels_and_conditional_formatting(dataiku.api_client()):
+        if apply_coloring_excel and supports_messaging_channels():
             format_params = {"applyColoring": True}
     else:
         request_fmt = "tsv-excel-header"
 
     # Prepare attachments
-    attachment_files = []
-    for attachment_ds in attachment_datasets:
-        with attachment_ds.raw_formatted_data(format=request_fmt, format_params=format_params) as stream:
-            file_bytes = stream.read()
-        if is_excel:
-            attachment_files.append(AttachmentFile(attachment_ds.full_name + ".xlsx", "application",
-                                                     "vnd.openxmlformats-officedocument.spreadsheetml.sheet", file_bytes))
-        else:
-            attachment_files.append(AttachmentFile(attachment_ds.full_name + ".csv", "text", "csv", file_bytes))
+    export_args = [(attachment_ds, request_fmt, format_params, export_cache, compression, dataset_file_type(attachment_ds, is_excel)[0])
+                   for attachment_ds in attachment_datasets]
+    if executor:
+        exports = [executor.submit(export_attachment, *args) for args in export_args]
+        exported_files = [export.result() for export in exports]
+    else:
+        exported_files = [export_attachment(*args) for args in export_args]
+    attachment_files = [dataset_attachment_file(attachment_ds, is_excel, file_bytes, compression)
+                        for attachment_ds, file_bytes in zip(attachment_datasets, exported_files)]
+    if max_message_size:
+        attachment_files = fit_message_size(attachment_files, compression, max_message_size)
     return attachment_files
+
+
+def dataframe_to_xlsx_bytes(df):
+    """
+    :param df: pandas DataFrame
+    :returns: bytes of an xlsx workbook with one sheet holding the dataframe, with a header row
+    """
+    # Imported here, only per contact excel attachments need it
+    import xlsxwriter
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+    worksheet = workbook.add_worksheet()
+    for column_index, column_name in enumerate(df.columns):
+        worksheet.write(0, column_index, str(column_name))
+    # tolist() converts numpy values to python ones, that xlsxwriter can write
+    for row_index, row in enumerate(df.astype(object).where(df.notnull(), None).values.tolist(), start=1):
+        for column_index, value in enumerate(row):
+            if value is None:
+                continue
+            if not isinstance(value, (int, float, bool, str)):
+                value = str(value)
+            worksheet.write(row_index, column_index, value)
+    workbook.close()
+    return output.getvalue()
+
+
+def attachment_key(key_value):
+    """
+    Normalize a key value so that contacts and attachments match whatever the column types, e.g. an int column of one
+    dataset and a bigint column with missing values, read as floats, of the other
+    :param key_value: value of a key column
+    :returns: str, None for a missing value. Integral floats give the string of the integer: 5, 5.0 and "5" give "5"
+    """
+    if pd.isna(key_value):
+        return None
+    if isinstance(key_value, float) and key_value.is_integer():
+        return str(int(key_value))
+    return str(key_value)
+
+
+class PartitionedAttachments:
+    """
+    Attachments filtered per contact: each contact only gets the rows of the attachment datasets whose key column
+    matches its own key value. Each dataset is read once and indexed by key, the file of each key is generated the first
+    time it is needed and cached, and contacts with the same key (or no matching rows) share the same AttachmentFile objects.
+    :param attachment_datasets: List of attachment datasets
+    :param attachment_type: str, "excel" or "csv" ("excel_can_ac" is treated as excel)
+    :param key_column: str, column of the attachment datasets matched against the contact key
+    :param cache_size: int, maximum number of keys whose files are kept
+    :param executor: concurrent.futures.Executor reading the datasets at the same time, None to read them one after another
+    :param compression: str, key of COMPRESSIONS to send compressed attachments, None to send them as is
+    :param max_message_size: int, bytes - the files of a key are compressed if they do not fit, 0 for no limit
+    """
+    def __init__(self, attachment_datasets, attachment_type, key_column, cache_size=1000, executor=None, compression=None, max_message_size=0):
+        self.is_excel = attachment_type == "excel" or attachment_type == "excel_can_ac"
+        self.compression = compression
+        self.max_message_size = max_message_size
+        self.key_column = key_column
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.datasets = []
+        if executor:
+            dataframes = [read.result() for read in [executor.submit(attachment_ds.get_dataframe) for attachment_ds in attachment_datasets]]
+        else:
+            dataframes = [attachment_ds.get_dataframe() for attachment_ds in attachment_datasets]
+        for attachment_ds, df in zip(attachment_datasets, dataframes):
+            if key_column not in df.columns:
+                raise AttributeError(f"The attachment key column ({key_column}) was not found in attachment dataset {attachment_ds.full_name}")
+            # Rows with a missing key are left out, they match no contact
+            row_indices = df.groupby(df[key_column].map(attachment_key), sort=False).indices
+            self.datasets.append((attachment_ds, df, row_indices))
+            logging.info(f"Indexed attachment {attachment_ds.full_name}: {len(df)} rows, {len(row_indices)} keys")
+
+    def files_for(self, key_value):
+        """
+        :param key_value: value of the contact key column
+        :returns: list of AttachmentFile, one per attachment dataset
+        """
+        key = attachment_key(key_value)
+        with self.lock:
+            files = self.cache.get(key)
+            if files is not None:
+                self.cache.move_to_end(key)
+                return files
+        files = [self.build_file(attachment_ds, df, row_indices.get(key, [])) for attachment_ds, df, row_indices in self.datasets]
+        if self.max_message_size:
+            # Raises for a key whose files do not fit even compressed, so its contacts fail without the email being tried
+            files = fit_message_size(files, self.compression, self.max_message_size)
+        with self.lock:
+            # Another thread may have built the same files meanwhile - keep only one copy so identical emails stay identical
+            files = self.cache.setdefault(key, files)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return files
+
+    @timed("export_attachments")
+    def build_file(self, attachment_ds, df, rows):
+        partition_df = df.iloc[rows]
+        if self.is_excel:
+            file_bytes = dataframe_to_xlsx_bytes(partition_df)
+        else:
+            # Same format as the tsv-excel-header export of the whole dataset
+            file_bytes = partition_df.to_csv(sep="\t", index=False).encode("utf-8")
+        attachment_file = dataset_attachment_file(attachment_ds, self.is_excel, file_bytes)
+        return compress_attachment(attachment_file, self.compression) if self.compression else attachment_file
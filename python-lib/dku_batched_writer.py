@@ -0,0 +1,38 @@
+# Output writer sending rows to DSS by batches, so the cost of writing does not grow with each row
+import time
+import pandas as pd
+from dku_metrics import METRICS
+
+
+class BatchedWriter:
+    """
+    Buffer output rows and write them as a dataframe every max_rows rows or max_interval seconds, whichever comes first.
+    The interval is checked when rows are added, so rows are written regularly as long as they keep coming.
+    :param writer: DSS dataset writer
+    :param column_names: list of str, output columns in schema order
+    :param max_rows: int, maximum number of rows buffered
+    :param max_interval: float, maximum number of seconds between two writes
+    """
+    def __init__(self, writer, column_names, max_rows=1000, max_interval=10.0):
+        self.writer = writer
+        self.column_names = column_names
+        self.max_rows = max(1, max_rows)
+        self.max_interval = max_interval
+        self.rows = []
+        self.last_flush_time = time.monotonic()
+        self.rows_written = 0
+
+    def write(self, values):
+        """ :param values: list of the values of a row, in the order of column_names """
+        self.rows.append(values)
+        if len(self.rows) >= self.max_rows or time.monotonic() - self.last_flush_time >= self.max_interval:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            with METRICS.timer("write_rows"):
+                # Object dtype keeps the values as they were read, e.g. integers of a column with missing values are not turned into floats
+                self.writer.write_dataframe(pd.DataFrame(self.rows, columns=self.column_names, dtype=object))
+            self.rows_written += len(self.rows)
+            self.rows = []
+        self.last_flush_time = time.monotonic()
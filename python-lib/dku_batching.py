@@ -0,0 +1,66 @@
+# Grouping of identical emails so they can be sent to several recipients at once
+import logging
+from dku_send_journal import ROW_KEY_COLUMN
+
+
+def group_identical_emails(rendered_contacts):
+    """
+    :param rendered_contacts: list of tuples (contact_dict, RenderedEmail or None), as returned by the rendering of each contact
+    :returns: list of groups of contacts with the same sender, subject, body and attachments, each a list of (contact_dict, RenderedEmail),
+              in order of first appearance
+    """
+    groups = {}
+    for contact_dict, email in rendered_contacts:
+        if email is None:
+            continue
+        key = (email.sender, email.subject, email.body, tuple(id(a) for a in email.attachment_files))
+        groups.setdefault(key, []).append((contact_dict, email))
+    return list(groups.values())
+
+
+def split_in_batches(group, max_batch_size):
+    """
+    Split the recipients of a group of identical emails into batches
+    :param group: list of (contact_dict, RenderedEmail)
+    :param max_batch_size: int, maximum number of recipients in a batch
+    :returns: generator of batches, each a list of (contact_dict, recipient)
+    """
+    batch = []
+    for contact_dict, email in group:
+        for recipient in email.recipients:
+            batch.append((contact_dict, recipient))
+            if len(batch) >= max_batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def send_in_batches(email_client, rendered_contacts, max_batch_size, journal=None):
+    """
+    Send emails that render identically (within a row or across rows) with as few client calls as possible,
+    setting the sendmail status of each contact - a contact fails if any of the batches it is part of fails
+    :param email_client: AbstractMessageClient
+    :param rendered_contacts: list of tuples (contact_dict, RenderedEmail or None) - None when rendering failed, then the status is already set
+    :param max_batch_size: int, maximum number of recipients per client call
+    :param journal: SendJournal where deliveries are recorded, optional
+    """
+    calls = 0
+    for group in group_identical_emails(rendered_contacts):
+        email = group[0][1]
+        for contact_dict, _ in group:
+            contact_dict['sendmail_status'] = 'SUCCESS'
+        for batch in split_in_batches(group, max_batch_size):
+            recipients = [recipient for _, recipient in batch]
+            calls += 1
+            try:
+                email_client.send_email(email.sender, recipients, email.subject, email.body, email.attachment_files)
+                if journal:
+                    for contact_dict, recipient in batch:
+                        journal.record_delivery(contact_dict[ROW_KEY_COLUMN], recipient)
+            except Exception as e:
+                logging.exception("Send failed")
+                for contact_dict, _ in batch:
+                    contact_dict['sendmail_status'] = 'FAILED'
+                    contact_dict['sendmail_error'] = str(e)
+    logging.info(f"Sent emails for {len(rendered_contacts)} rows in {calls} batch(es)")
@@ -0,0 +1,91 @@
+# Compression of attachments - the compressor runs in a worker thread, while the data is still being read from DSS
+import gzip
+import io
+import queue
+import threading
+import zipfile
+from dku_spooled_buffer import SpooledBuffer, CHUNK_SIZE
+
+# Supported compressions: file name extension and mime subtype (the mime type is always application)
+COMPRESSIONS = {
+    "zip": (".zip", "zip"),
+    "gzip": (".gz", "gzip")
+}
+
+
+class SpooledBufferWriter(io.RawIOBase):
+    """ Write-only, non seekable file object appending to a SpooledBuffer, for the zipfile and gzip writers """
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.write(bytes(data))
+        return len(data)
+
+    def tell(self):
+        return self.buffer.size
+
+
+def compress_chunks(chunks, file_name, compression, queue_size=8):
+    """
+    Compress data arriving in chunks: the chunks are iterated in the calling thread (e.g. read from a DSS export) while a worker
+    thread compresses them, with at most queue_size chunks waiting in between
+    :param chunks: iterable of bytes
+    :param file_name: str, name of the file within the archive
+    :param compression: str, key of COMPRESSIONS
+    :returns: SpooledBuffer holding the zip archive or gzip file
+    """
+    if compression not in COMPRESSIONS:
+        raise Exception(f"Unknown attachment compression {compression}")
+    compressed = SpooledBuffer()
+    pending_chunks = queue.Queue(maxsize=queue_size)
+    errors = []
+    end_reached = threading.Event()
+
+    def compress():
+        try:
+            writer = SpooledBufferWriter(compressed)
+            if compression == "zip":
+                with zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as archive:
+                    # The size is not known in advance, zip64 headers allow files of more than 2GB
+                    with archive.open(file_name, "w", force_zip64=True) as archived_file:
+                        write_chunks(archived_file)
+            else:
+                with gzip.GzipFile(filename=file_name, mode="wb", fileobj=writer) as gzip_file:
+                    write_chunks(gzip_file)
+        except Exception as e:
+            errors.append(e)
+            # Keep consuming, so the reading thread is never blocked on a full queue
+            while not end_reached.is_set() and pending_chunks.get() is not None:
+                pass
+
+    def write_chunks(target):
+        while True:
+            chunk = pending_chunks.get()
+            if chunk is None:
+                end_reached.set()
+                return
+            target.write(chunk)
+
+    worker = threading.Thread(target=compress, name="attachment-compression", daemon=True)
+    worker.start()
+    try:
+        for chunk in chunks:
+            if errors:
+                # No use reading the rest
+                break
+            pending_chunks.put(chunk)
+    finally:
+        pending_chunks.put(None)
+        worker.join()
+    if errors:
+        raise errors[0]
+    return compressed
+
+
+def compress_stream(stream, file_name, compression):
+    """ compress_chunks of a readable binary stream, e.g. a DSS export """
+    return compress_chunks(iter(lambda: stream.read(CHUNK_SIZE), b""), file_name, compression)
@@ -0,0 +1,419 @@
+# Helpers to run the per-contact work concurrently while keeping the output in input order
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ordered_map(func, items, max_workers, max_pending=None):
+    """
+    Apply func to each item with a pool of threads, yielding the results in the same order as the input
+    Items are consumed lazily - at most max_pending of them are queued or in flight at any time,
+    so a large input is never read into memory ahead of the workers.
+    :param func: function called with one item, should handle its own errors
+    :param items: iterable of items
+    :param max_workers: int, number of worker threads - 1 or less means run in the calling thread
+    :param max_pending: int, bound of the work queue, defaults to twice the number of workers
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    if not max_pending or max_pending < max_workers:
+        max_pending = 2 * max_workers
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def ordered_submit(submit, finish, items, max_pending):
+    """
+    Start the work of each item without waiting for it, then finish the items in input order - for work done by an
+    asynchronous client rather than by a pool of threads. At most max_pending items are started and not finished at any time
+    :param submit: function called with one item, starts its work and returns a handle on it (e.g. futures)
+    :param finish: function called with an item and its handle, once the previous items are finished - returns the result
+    :param items: iterable of items
+    :param max_pending: int, number of items in flight
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, submit(item)))
+        if len(pending) >= max_pending:
+            yield finish(*pending.popleft())
+    while pending:
+        yield finish(*pending.popleft())
+
+
+class PipelineStage:
+    """
+    One step of a Pipeline, run by its own pool of worker threads
+    :param name: str, name used in the stage counters
+    :param func: function transforming an item for the next stage, should handle its own errors
+    :param workers: int, number of worker threads for this stage
+    :param ordered: bool, whether func is called on the items in input order - the stage then has a single worker, holding the
+                    items received ahead of their turn
+    """
+    def __init__(self, name, func, workers=1, ordered=False):
+        self.name = name
+        self.func = func
+        self.ordered = ordered
+        self.workers = 1 if ordered else max(1, workers)
+        self.counters = StageCounters(name, self.workers)
+
+
+class StageCounters:
+    """
+    Counters of a pipeline stage - time is summed over the stage workers:
+    busy time spent processing items, starved time waiting for input and blocked time waiting for the next stage to have room
+    """
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy_time = 0.0
+        self.starved_time = 0.0
+        self.blocked_time = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, items=0, busy_time=0.0, starved_time=0.0, blocked_time=0.0):
+        with self.lock:
+            self.items += items
+            self.busy_time += busy_time
+            self.starved_time += starved_time
+            self.blocked_time += blocked_time
+
+    def utilisation(self, elapsed_time):
+        """ :returns: share of the available worker time spent processing, the stage with the highest one limits throughput """
+        if elapsed_time <= 0:
+            return 0.0
+        return self.busy_time / (elapsed_time * self.workers)
+
+    def summary(self, elapsed_time):
+        return (f"{self.name}: {self.items} items, {self.workers} worker(s), busy {self.busy_time:.1f}s "
+                f"({100 * self.utilisation(elapsed_time):.0f}%), starved {self.starved_time:.1f}s, blocked {self.blocked_time:.1f}s")
+
+
+class Pipeline:
+    """
+    Process items through successive stages running concurrently: a reader thread feeds the first stage, each stage
+    has its own pool of workers, and results are yielded in input order to the caller (the single writer).
+    Queues between stages are bounded, and so is the number of items in flight, so a slow stage applies backpressure
+    all the way to the reader.
+    :param stages: list of PipelineStage
+    :param queue_size: int, capacity of the queue in front of each stage
+    :param max_in_flight: int, maximum number of items read but not yet yielded, defaults to all queues and workers being full
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, stages, queue_size=100, max_in_flight=None):
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        if not max_in_flight:
+            max_in_flight = sum(self.queue_size + stage.workers for stage in stages) + self.queue_size
+        self.max_in_flight = max_in_flight
+        self.read_counters = StageCounters("read", 1)
+        self.write_counters = StageCounters("write", 1)
+        self.elapsed_time = 0.0
+
+    def all_counters(self):
+        return [self.read_counters] + [stage.counters for stage in self.stages] + [self.write_counters]
+
+    def log_summary(self):
+        for counters in self.all_counters():
+            logging.info(f"Pipeline stage {counters.summary(self.elapsed_time)}")
+        bottleneck = max(self.all_counters(), key=lambda c: c.utilisation(self.elapsed_time))
+        logging.info(f"Pipeline ran for {self.elapsed_time:.1f}s, most loaded stage: {bottleneck.name}")
+
+    def run(self, items):
+        """
+        :param items: iterable of items, read from a separate thread
+        :returns: generator of the results of the last stage, in input order
+        """
+        start_time = time.perf_counter()
+        stop_event = threading.Event()
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        # Set by the reader once the input is exhausted (or failed)
+        read_state = {"total": None, "error": None}
+
+        def put(target_queue, value, counters):
+            wait_start = time.perf_counter()
+            while not stop_event.is_set():
+                try:
+                    target_queue.put(value, timeout=self.POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    pass
+            counters.add(blocked_time=time.perf_counter() - wait_start)
+
+        def read():
+            count = 0
+            try:
+                iterator = iter(items)
+                while not stop_event.is_set():
+                    read_start = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                    self.read_counters.add(items=1, busy_time=time.perf_counter() - read_start)
+                    wait_start = time.perf_counter()
+                    while not in_flight.acquire(timeout=self.POLL_INTERVAL):
+                        if stop_event.is_set():
+                            return
+                    self.read_counters.add(blocked_time=time.perf_counter() - wait_start)
+                    put(queues[0], (count, item, None), self.read_counters)
+                    count += 1
+            except Exception as exp:
+                read_state["error"] = exp
+            finally:
+                read_state["total"] = count
+
+        def work(stage, input_queue, output_queue):
+            # Ordered stage - items received before the previous ones, by index
+            held_items = {}
+            next_index = 0
+            while not stop_event.is_set():
+                wait_start = time.perf_counter()
+                try:
+                    received = input_queue.get(timeout=self.POLL_INTERVAL)
+                except queue.Empty:
+                    stage.counters.add(starved_time=time.perf_counter() - wait_start)
+                    continue
+                stage.counters.add(starved_time=time.perf_counter() - wait_start)
+                ready = [received]
+                if stage.ordered:
+                    held_items[received[0]] = received
+                    ready = []
+                    while next_index in held_items:
+                        ready.append(held_items.pop(next_index))
+                        next_index += 1
+                for index, item, error in ready:
+                    work_start = time.perf_counter()
+                    # Errors raised by a previous stage are passed along to the writer, which re-raises them in the calling thread
+                    result = None
+                    if error is None:
+                        try:
+                            result = stage.func(item)
+                        except Exception as exp:
+                            error = exp
+                        stage.counters.add(items=1, busy_time=time.perf_counter() - work_start)
+                    put(output_queue, (index, result, error), stage.counters)
+
+        threads = [threading.Thread(target=read, name="pipeline-read", daemon=True)]
+        for stage_index, stage in enumerate(self.stages):
+            for worker_index in range(stage.workers):
+                threads.append(threading.Thread(target=work, args=(stage, queues[stage_index], queues[stage_index + 1]),
+                                                name=f"pipeline-{stage.name}-{worker_index}", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        # Writer side - reorder results, yielding each one as soon as all the previous ones have been
+        pending_results = {}
+        next_index = 0
+        try:
+            while True:
+                if read_state["total"] is not None and next_index >= read_state["total"]:
+                    break
+                if next_index in pending_results:
+                    result, error = pending_results.pop(next_index)
+                    if error is not None:
+                        raise error
+                    write_start = time.perf_counter()
+                    yield result
+                    self.write_counters.add(items=1, busy_time=time.perf_counter() - write_start)
+                    in_flight.release()
+                    next_index += 1
+                    continue
+                wait_start = time.perf_counter()
+                try:
+                    index, result, error = queues[-1].get(timeout=self.POLL_INTERVAL)
+                    pending_results[index] = (result, error)
+                except queue.Empty:
+                    pass
+                self.write_counters.add(starved_time=time.perf_counter() - wait_start)
+            if read_state["error"] is not None:
+                raise read_state["error"]
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+            self.elapsed_time = time.perf_counter() - start_time
+
+
+class ShardedRunner:
+    """
+    Process a stream of items in several worker processes (shards), so that CPU bound work is not limited by the GIL.
+    Items are read in the calling process and dispatched to the shards either by blocks of consecutive items or by a hash
+    of a key (so that items with the same key always go to the same shard), results are yielded in input order.
+    Worker processes are forked, so they start with a copy of the state of the calling process - items and results are
+    pickled, sent by chunks through bounded queues. Threads started by the caller must be idle when run is called: a lock held
+    by one of them is copied in the held state, with no thread left in the workers to release it.
+    :param process_stream: function called in each worker with an iterable of items, returning an iterable of one result per item in order
+    :param shards: int, number of worker processes
+    :param shard_key: function returning the key of an item, items are dispatched by blocks of chunk_size items if None
+    :param initializer: function called in each worker process before processing any item, e.g. to open its own connections
+    :param finalizer: function called in each worker process once all its items are processed, what it returns (picklable)
+                      is added to finalizer_results in the calling process
+    :param chunk_size: int, number of items sent to a worker at once
+    :param queue_size: int, number of chunks queued for each worker
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, process_stream, shards, shard_key=None, initializer=None, finalizer=None, chunk_size=100, queue_size=4):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise Exception("Sending from several processes is not supported on this platform")
+        self.process_stream = process_stream
+        self.shards = max(1, shards)
+        self.shard_key = shard_key
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self.chunk_size = max(1, chunk_size)
+        self.queue_size = max(1, queue_size)
+        self.context = multiprocessing.get_context("fork")
+        self.shard_items = [0] * self.shards
+        self.finalizer_results = []
+
+    def shard_of(self, index, item):
+        if self.shard_key is None:
+            return (index // self.chunk_size) % self.shards
+        key = str(self.shard_key(item)).strip().lower()
+        return zlib.crc32(key.encode("utf-8")) % self.shards
+
+    def work(self, shard, input_queue, result_queue):
+        """ Main function of a worker process """
+        try:
+            if self.initializer:
+                self.initializer()
+            indices = deque()
+
+            def shard_items():
+                while True:
+                    chunk = input_queue.get()
+                    if chunk is None:
+                        return
+                    for index, item in chunk:
+                        indices.append(index)
+                        yield item
+
+            results = []
+            for result in self.process_stream(shard_items()):
+                results.append((indices.popleft(), result))
+                # Results are sent as soon as all the items received so far are processed, or by chunks
+                if len(results) >= self.chunk_size or not indices:
+                    result_queue.put(("results", shard, results))
+                    results = []
+            if results:
+                result_queue.put(("results", shard, results))
+            result_queue.put(("done", shard, self.finalizer() if self.finalizer else None))
+        except Exception:
+            result_queue.put(("error", shard, traceback.format_exc()))
+
+    def run(self, items):
+        """
+        :param items: iterable of items, read from a separate thread of the calling process
+        :returns: generator of the results, in input order
+        """
+        input_queues = [self.context.Queue(self.queue_size) for _ in range(self.shards)]
+        result_queue = self.context.Queue()
+        # Processes are forked before the reader thread of this run starts, so that its locks are not copied while held
+        processes = [self.context.Process(target=self.work, args=(shard, input_queues[shard], result_queue),
+                                          name=f"sendmail-shard-{shard}", daemon=True)
+                     for shard in range(self.shards)]
+        for process in processes:
+            process.start()
+        logging.info(f"Started {self.shards} sending processes")
+
+        stop_event = threading.Event()
+        read_state = {"total": None, "error": None}
+
+        def put(shard, value):
+            while not stop_event.is_set():
+                try:
+                    input_queues[shard].put(value, timeout=self.POLL_INTERVAL)
+                    return
+                except queue.Full:
+                    pass
+
+        def read():
+            count = 0
+            chunks = [[] for _ in range(self.shards)]
+            try:
+                for item in items:
+                    if stop_event.is_set():
+                        return
+                    shard = self.shard_of(count, item)
+                    chunks[shard].append((count, item))
+                    self.shard_items[shard] += 1
+                    count += 1
+                    if len(chunks[shard]) >= self.chunk_size:
+                        put(shard, chunks[shard])
+                        chunks[shard] = []
+                for shard, chunk in enumerate(chunks):
+                    if chunk:
+                        put(shard, chunk)
+            except Exception as exp:
+                read_state["error"] = exp
+            finally:
+                read_state["total"] = count
+                for shard in range(self.shards):
+                    put(shard, None)
+
+        reader = threading.Thread(target=read, name="shards-read", daemon=True)
+        reader.start()
+
+        pending_results = {}
+        next_index = 0
+        finished_shards = set()
+
+        def receive():
+            """ Handle the next message of the workers, if one comes within the poll interval """
+            try:
+                message_type, shard, payload = result_queue.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                for shard, process in enumerate(processes):
+                    if shard not in finished_shards and not process.is_alive():
+                        raise Exception(f"Sending process {shard} stopped unexpectedly (exit code {process.exitcode})")
+                return
+            if message_type == "results":
+                pending_results.update(payload)
+            elif message_type == "done":
+                finished_shards.add(shard)
+                self.finalizer_results.append(payload)
+            else:
+                raise Exception(f"Sending process {shard} failed: {payload}")
+
+        try:
+            while read_state["total"] is None or next_index < read_state["total"]:
+                if next_index in pending_results:
+                    yield pending_results.pop(next_index)
+                    next_index += 1
+                else:
+                    receive()
+            if read_state["error"] is not None:
+                raise read_state["error"]
+            # Wait for the finalizers, so that everything done in the workers is complete when the generator ends
+            while len(finished_shards) < self.shards:
+                receive()
+        finally:
+            stop_event.set()
+            reader.join()
+            is_complete = len(finished_shards) == self.shards
+            for shard, process in enumerate(processes):
+                if not is_complete:
+                    # Chunks left in the queue must not keep the calling process from exiting
+                    input_queues[shard].cancel_join_thread()
+                    process.terminate()
+                process.join()
+            logging.info(f"Items per sending process: {self.shard_items}")
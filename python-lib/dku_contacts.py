@@ -0,0 +1,60 @@
+# Reading of the contacts dataset: only the columns needed are read, rows are kept as tuples and only the columns used
+# to build the emails are put in the contact dicts
+from operator import itemgetter
+
+# Key of the contact dict holding the tuple of the full record of the row, when it is needed for the output
+RECORD_KEY = "__sendmail_record"
+# Output column identifying each row by its position in the contacts dataset, when the contact columns are not all written
+ROW_NUMBER_COLUMN = "sendmail_row_number"
+
+
+class ContactReader:
+    """
+    :param dataset: contacts dataset
+    :param schema_columns: list of str, names of the columns of the dataset, in schema order
+    :param context_columns: iterable of str, columns needed to build the emails - the contact dicts only hold these
+    :param output_columns: list of str, columns of the contacts written to the output, all of them if None. If only some
+                           are, they must be context columns and only the context columns are read
+    """
+    def __init__(self, dataset, schema_columns, context_columns, output_columns=None):
+        self.dataset = dataset
+        self.schema_columns = list(schema_columns)
+        context_columns = set(context_columns)
+        self.output_columns = self.schema_columns if output_columns is None else list(output_columns)
+        self.read_columns = self.schema_columns if output_columns is None else [c for c in self.schema_columns if c in context_columns]
+        self.context_columns = [c for c in self.read_columns if c in context_columns]
+        # The full record of each row is kept for the output, unless all its columns are in the contact dicts anyway
+        self.keep_records = output_columns is None and len(self.context_columns) < len(self.read_columns)
+        context_indices = [self.read_columns.index(c) for c in self.context_columns]
+        # itemgetter returns a bare value instead of a tuple when given a single index
+        if len(context_indices) == 1:
+            self.context_values = lambda record: (record[context_indices[0]],)
+        else:
+            self.context_values = itemgetter(*context_indices) if context_indices else lambda record: ()
+
+    def iter_contacts(self):
+        """ :returns: generator of contact dicts, one per row, with the full record under RECORD_KEY if keep_records """
+        # The projection is only passed when it removes columns, reading everything is the usual path of DSS
+        columns = None if len(self.read_columns) == len(self.schema_columns) else self.read_columns
+        context_columns = self.context_columns
+        context_values = self.context_values
+        for record in self.dataset.iter_tuples(columns=columns):
+            contact_dict = dict(zip(context_columns, context_values(record)))
+            if self.keep_records:
+                contact_dict[RECORD_KEY] = record
+            yield contact_dict
+
+    def output_values(self, contact_dict, extra_columns):
+        """
+        :param contact_dict: contact dict as yielded by iter_contacts, or output row dict from a previous run
+        :param extra_columns: list of str, output columns added after the contact columns (status, error...)
+        :returns: list of the output values, in the order of output_columns then extra_columns
+        """
+        record = contact_dict.get(RECORD_KEY)
+        if record is None:
+            # Row without its record, e.g. the output recorded in the journal by a previous run
+            values = [contact_dict.get(c) for c in self.output_columns]
+        else:
+            values = list(record)
+        values.extend(contact_dict.get(c) for c in extra_columns)
+        return values
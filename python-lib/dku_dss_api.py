@@ -0,0 +1,84 @@
+# Cached access to the DSS API, so that repeated lookups within a process do not each make a round trip to DSS
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import dataiku
+from dku_support_detection import supports_messaging_channels_and_conditional_formatting
+
+# Seconds the channel metadata is kept - channels rarely change, but an edited channel should be picked up by long lived processes
+CHANNELS_CACHE_TTL = 60.0
+
+
+def ttl_cache(ttl):
+    """
+    Decorator keeping the result of the function for each value of its (hashable) arguments, for ttl seconds.
+    The process id is part of the key, so a forked process makes its own calls instead of sharing the connections of its parent.
+    :param ttl: float, seconds a result is kept
+    """
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (os.getpid(),) + args
+            with lock:
+                entry = cache.get(key)
+            if entry is not None and time.monotonic() - entry[0] < ttl:
+                return entry[1]
+            value = func(*args)
+            with lock:
+                cache[key] = (time.monotonic(), value)
+            return value
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+
+@ttl_cache(float("inf"))
+def api_client():
+    """ :returns: the DSS API client of this process, created once """
+    return dataiku.api_client()
+
+
+@ttl_cache(float("inf"))
+def supports_messaging_channels():
+    return supports_messaging_channels_and_conditional_formatting(api_client())
+
+
+@ttl_cache(CHANNELS_CACHE_TTL)
+def get_messaging_channel(channel_id):
+    return api_client().get_messaging_channel(channel_id)
+
+
+@ttl_cache(CHANNELS_CACHE_TTL)
+def list_mail_channels():
+    """ :returns: list of the mail messaging channels, empty if the DSS version does not support them """
+    if not supports_messaging_channels():
+        return []
+    return api_client().list_messaging_channels(as_type="objects", channel_family="mail")
+
+
+def get_dataset_data_version(full_name):
+    """
+    :param full_name: str, PROJECT_KEY.dataset_name
+    :returns: str identifying the data of a dataset built by DSS (end of its last build and version of its settings), None if it
+              cannot be known - e.g. for a source dataset, whose data can change without DSS knowing
+    """
+    project_key, dataset_name = full_name.split(".", 1)
+    try:
+        info = api_client().get_project(project_key).get_dataset(dataset_name).get_info().get_raw()
+    except Exception as e:
+        logging.info(f"Could not get the build info of dataset {full_name}: {e}")
+        return None
+    build_end_time = info.get("lastBuild", {}).get("buildEndTime")
+    if not build_end_time:
+        return None
+    return json.dumps([build_end_time, info.get("dataset", {}).get("versionTag")], sort_keys=True)
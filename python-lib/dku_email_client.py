@@ -2,9 +2,103 @@ import dataiku
 import logging
 from abc import ABC, abstractmethod
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
+import queue
+import threading
+import uuid
+import re
+import base64
+import hashlib
+import time
+import asyncio
+import socket
+from dku_metrics import METRICS, timed
+from dku_dss_api import get_messaging_channel
+from dku_rate_limiting import RetryPolicy, is_temporary_smtp_error
+from dku_spooled_buffer import SpooledBuffer, CHUNK_SIZE
+from dku_async_smtp import AsyncSmtpConnection, envelope_bytes, starttls_context
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Messages are cached with this value in the To header, replaced by the actual recipients when sending
+TO_PLACEHOLDER = "sendmail-to-placeholder-" + uuid.uuid4().hex
+# Header values that the email package writes as is (no encoding), so they can be patched into a cached message
+PLAIN_HEADER_VALUE = re.compile(r"^[\x20-\x7e]*$")
+
+
+def to_smtp_wire_format(text):
+    """
+    Same transformation smtplib applies to a message before the DATA command: CRLF line endings and leading dots doubled
+    :param text: str, ascii message text
+    :returns: bytes
+    """
+    text = re.sub(r'(?:\r\n|\n|\r(?!\n))', "\r\n", text)
+    return re.sub(r'(?m)^\.', '..', text).encode("ascii")
+
+
+def reset_transaction(smtp):
+    # Abort the current mail transaction, ignoring a connection that is already closed (as smtplib does internally)
+    try:
+        smtp.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+def send_message_chunks(smtp, sender, recipients, message_chunks):
+    """
+    Equivalent of smtplib.SMTP.sendmail, but streams the message to the server chunk by chunk rather than as one string
+    :param smtp: smtplib.SMTP, connected (and logged in if needed)
+    :param sender: str
+    :param recipients: list of str
+    :param message_chunks: iterable of bytes, message already in SMTP wire format (see to_smtp_wire_format)
+    :returns: dict of refused recipients, as sendmail does
+    """
+    smtp.ehlo_or_helo_if_needed()
+    (code, resp) = smtp.mail(sender)
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            reset_transaction(smtp)
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    refused = {}
+    for recipient in recipients:
+        (code, resp) = smtp.rcpt(recipient)
+        if (code != 250) and (code != 251):
+            refused[recipient] = (code, resp)
+        if code == 421:
+            smtp.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(recipients):
+        # the server refused all our recipients
+        reset_transaction(smtp)
+        raise smtplib.SMTPRecipientsRefused(refused)
+    (code, resp) = smtp.docmd("data")
+    if code != 354:
+        reset_transaction(smtp)
+        raise smtplib.SMTPDataError(code, resp)
+    # Small chunks (headers, boundaries) are coalesced into larger writes: many small writes on the socket
+    # trigger Nagle / delayed ACK stalls of tens of milliseconds per message
+    pending = bytearray()
+    last_bytes = b""
+    for chunk in message_chunks:
+        pending += chunk
+        last_bytes = (last_bytes + chunk[-2:])[-2:]
+        if len(pending) >= CHUNK_SIZE:
+            smtp.send(bytes(pending))
+            pending.clear()
+    if last_bytes != b"\r\n":
+        pending += b"\r\n"
+    pending += b".\r\n"
+    smtp.send(bytes(pending))
+    (code, resp) = smtp.getreply()
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            reset_transaction(smtp)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
 
 class SmtpConfig:
     """
@@ -25,18 +119,37 @@ class SmtpConfig:
         self.smtp_pass = smtp_pass
 
 
+def base64_encoded_size(size):
+    """ :returns: int, size of data of the given size once base64 encoded in a message, in 76 chars lines """
+    encoded_size = 4 * ((size + 2) // 3)
+    return encoded_size + 2 * ((encoded_size + 75) // 76)
+
+
 class AttachmentFile:
     """
     :param file_name: str, name of file including extension
     :param mime_type: main maime type str before / ('application' or 'text')
     :param mime_subtype: str -mime type bit after /, e.g. csv in text/csv
-    :param data: bytes, actual data of attachment
+    :param data: actual data of attachment, bytes or SpooledBuffer for large files
     """
     def __init__(self, file_name, mime_type, mime_subtype, data):
         self.file_name = file_name
         self.mime_type = mime_type
         self.mime_subtype = mime_subtype
-        self.data = data
+        if isinstance(data, SpooledBuffer):
+            self.content = data
+        else:
+            self.content = SpooledBuffer()
+            self.content.write(data)
+
+    @property
+    def data(self):
+        """ Whole content of the attachment, as bytes """
+        return self.content.read_all()
+
+    @property
+    def size(self):
+        return self.content.size
 
 
 class AbstractMessageClient(ABC):
@@ -69,93 +182,595 @@ class AbstractMessageClient(ABC):
 
 
 class ChannelClient(AbstractMessageClient):
-    """ Impl using DSS channels that requires DSS 12.6 or later """
-    def __init__(self, plain_text, channel_id):
+    """ Impl using DSS channels that requires DSS 12.6 or later
+    :param plain_text: bool, whether the body is sent as plain text
+    :param channel_id: str, id of the DSS messaging channel
+    :param max_batch_size: int, maximum number of recipients of a single channel call - 1 sends a separate email to each recipient
+    """
+    def __init__(self, plain_text, channel_id, max_batch_size=1):
         super().__init__(plain_text)
 
-        dss_api_client = dataiku.api_client()
         self.project_id = dataiku.default_project_key()
-        self.channel = dss_api_client.get_messaging_channel(channel_id)
+        self.channel = get_messaging_channel(channel_id)
+        self.max_batch_size = max(1, max_batch_size)
+        # Content of the attachments, read once (from disk for spooled ones) and reused for every contact - bounded for
+        # runs with a different attachment per contact
+        self.attachment_bytes_cache = OrderedDict()
+        self.max_cached_attachments = 256
+        self.cache_lock = threading.Lock()
 
         logging.info(f"Configured channel messaging client with channel {channel_id} - type: {self.channel.type}, "
-                     f"sender: {self.channel.sender}, plain_text? {self.plain_text}")
+                     f"sender: {self.channel.sender}, plain_text? {self.plain_text}, max batch size: {self.max_batch_size}")
 
+    @timed("channel_send")
     def send_email(self, sender, recipients, email_subject, email_body, attachment_files):
-        files = [(a.file_name, a.data, f"{a.mime_type}/{a.mime_subtype}") for a in attachment_files]
+        """
+        Sends the email with one channel call per batch of at most max_batch_size recipients.
+        Recipients of the same batch receive a single email addressed to all of them.
+        """
+        files = [(a.file_name, self.attachment_bytes(a), f"{a.mime_type}/{a.mime_subtype}") for a in attachment_files]
         sender_to_use = None if self.channel.sender else sender
+        for batch_start in range(0, len(recipients), self.max_batch_size):
+            batch = recipients[batch_start:batch_start + self.max_batch_size]
+            self.channel.send(self.project_id, batch, email_subject, email_body, attachments=files, plain_text=self.plain_text, sender=sender_to_use)
+
+    def attachment_bytes(self, attachment_file):
+        """
+        :param attachment_file: AttachmentFile
+        :returns: bytes, whole content of the attachment - cached, as the same attachment files are sent to every contact
+        """
+        with self.cache_lock:
+            cached = self.attachment_bytes_cache.get(id(attachment_file))
+            if cached is None:
+                # Keep a reference on the file so its id cannot be reused while cached
+                cached = (attachment_file, attachment_file.data)
+                self.attachment_bytes_cache[id(attachment_file)] = cached
+                if len(self.attachment_bytes_cache) > self.max_cached_attachments:
+                    self.attachment_bytes_cache.popitem(last=False)
+            else:
+                self.attachment_bytes_cache.move_to_end(id(attachment_file))
+        return cached[1]
+
+    def quit(self):
+        self.attachment_bytes_cache = OrderedDict()
+
+
+class MessageCache:
+    """
+    Thread-safe LRU cache bounded by the total size of its values, in bytes
+    :param max_bytes: int, the least recently used entries are evicted above this size
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, value_size):
+        if value_size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (value, value_size)
+            self.size += value_size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+class PooledConnection:
+    """ SMTP connection of the pool, with the number of messages sent over it """
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.messages_sent = 0
+
+
+class MessageBuilder:
+    """
+    Builds messages in SMTP wire format, for the clients sending them over SMTP and for dry runs.
+    Clients call init_message_builder from their constructor and set plain_text
+    """
+    def init_message_builder(self, message_cache_bytes):
+        """ State used to build the messages, see build_message """
+        # Attachments are encoded once and reused for every message, all messages of the run share the same MIME boundary
+        self.boundary = "===============" + uuid.uuid4().hex + "=="
+        self.encoded_attachments_cache = OrderedDict()
+        # Bound of the cache, for runs with a different attachment per contact
+        self.max_cached_attachments = 256
+        self.encoding_lock = threading.Lock()
+        # Serialized headers and body of recent messages, so identical emails to different recipients are only serialized once
+        self.message_cache = MessageCache(message_cache_bytes)
+
+    @timed("attachments_to_mime")
+    def attachments_to_mime(self, attachment_files):
+        """
+        :param attachment_files:attachment_files as list of AttachmentFile
+        :returns: the MIME headers of each attachment part, list of MIMEBase without payload - content is base64 encoded separately
+        """
+        # Imported here, only SMTP sending needs to build MIME messages
+        from email.mime.base import MIMEBase
+        attachment_mimes = [];
+        for attachment_file in attachment_files:
+            if attachment_file.mime_type == "application":
+                mime_app = MIMEBase(attachment_file.mime_type, attachment_file.mime_subtype)
+            elif attachment_file.mime_type == "text":
+                mime_app = MIMEBase(attachment_file.mime_type, attachment_file.mime_subtype, charset="utf-8")
+            else:
+                raise Exception(f'Cannot handle mime type {attachment_file.mime_type}')
+            mime_app["Content-Transfer-Encoding"] = "base64"
+            mime_app.add_header("Content-Disposition", 'attachment', filename=attachment_file.file_name)
+            mime_app.set_payload("")
+            attachment_mimes.append(mime_app)
+        return attachment_mimes
+
+    def encode_attachment(self, attachment_file, mime_app):
+        """
+        Write an attachment in SMTP wire format, base64 encoding its content one chunk at a time
+        :param attachment_file: AttachmentFile
+        :param mime_app: MIMEBase, headers of the part
+        :returns: SpooledBuffer
+        """
+        headers = mime_app.as_string()
+        if self.boundary in headers:
+            raise Exception(f"Attachment {attachment_file.file_name} headers contain the MIME boundary {self.boundary}")
+        encoded_part = SpooledBuffer()
+        encoded_part.write(to_smtp_wire_format(headers))
+        # Chunks are a multiple of 57 bytes so each is encoded to complete 76 chars lines, exactly as a one-shot encoding would
+        for chunk in attachment_file.content.iter_chunks(CHUNK_SIZE):
+            encoded_part.write(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
+        logging.info(f"Encoded attachment {attachment_file.file_name}: {attachment_file.size} bytes, {encoded_part.size} bytes encoded, "
+                     f"peak memory buffer {encoded_part.peak_memory_size} bytes "
+                     f"({'in memory' if encoded_part.is_in_memory() else 'spooled to disk'})")
+        return encoded_part
+
+    def encoded_attachments(self, attachment_files):
+        """
+        Serialize each attachment to its final wire format (MIME headers + base64 content) once per run.
+        The result is cached, as the same attachment files are sent to every contact
+        :param attachment_files: attachment_files as list of AttachmentFile
+        :returns: the serialized MIME parts, list of SpooledBuffer
+        """
+        encoded_parts = []
+        for attachment_file in attachment_files:
+            with self.encoding_lock:
+                cached = self.encoded_attachments_cache.get(id(attachment_file))
+                if cached is None:
+                    mime_app = self.attachments_to_mime([attachment_file])[0]
+                    # Keep a reference on the file so its id cannot be reused while cached
+                    cached = (attachment_file, self.encode_attachment(attachment_file, mime_app))
+                    self.encoded_attachments_cache[id(attachment_file)] = cached
+                    if len(self.encoded_attachments_cache) > self.max_cached_attachments:
+                        # Evicted parts are not closed, messages being sent may still read them - they are freed once unused
+                        self.encoded_attachments_cache.popitem(last=False)
+                else:
+                    self.encoded_attachments_cache.move_to_end(id(attachment_file))
+            encoded_parts.append(cached[1])
+        return encoded_parts
+
+    def serialize_message(self, sender, to_value, email_subject, email_body):
+        """
+        Serialize headers and body of a message to SMTP wire format, split where the attachment parts go
+        :returns: tuple of bytes (head, closing) - the attachment parts are to be inserted between the two
+        """
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        msg = MIMEMultipart(boundary=self.boundary)
+        msg["From"] = sender
+        msg["To"] = to_value
+        msg["Subject"] = email_subject
+        body_encoding = "utf-8"
+        text_type = 'plain' if self.plain_text else 'html'
+        msg.attach(MIMEText(email_body, text_type, body_encoding))
+        message_text = msg.as_string()
+        # The attachment parts go just before the closing boundary, exactly where the generator would have written them
+        head, closing_delimiter, tail = message_text.rpartition("\n--" + self.boundary + "--")
+        return to_smtp_wire_format(head), to_smtp_wire_format(closing_delimiter + tail)
+
+    def message_parts(self, sender, recipients, email_subject, email_body):
+        """
+        Serialized headers and body of a message, taken from the message cache when the same sender, subject and body
+        were already serialized - only the To header is patched in per recipient
+        :returns: tuple of bytes (head, closing) as returned by serialize_message
+        """
+        to_value = ",".join(recipients)
+        if not PLAIN_HEADER_VALUE.match(to_value):
+            # Non ascii addresses are encoded by the email package, they cannot simply be patched in
+            return self.serialize_message(sender, to_value, email_subject, email_body)
+        cache_key = hashlib.sha256("\0".join(str(value) for value in (sender, email_subject, email_body))
+                                   .encode("utf-8", "surrogatepass")).digest()
+        cached = self.message_cache.get(cache_key)
+        if cached is None:
+            head, closing = self.serialize_message(sender, TO_PLACEHOLDER, email_subject, email_body)
+            if head.count(TO_PLACEHOLDER.encode("ascii")) != 1:
+                return self.serialize_message(sender, to_value, email_subject, email_body)
+            before_to, _, after_to = head.partition(TO_PLACEHOLDER.encode("ascii"))
+            cached = (before_to, after_to, closing)
+            self.message_cache.put(cache_key, cached, len(before_to) + len(after_to) + len(closing))
+        else:
+            METRICS.increment("message_cache_hits")
+        before_to, after_to, closing = cached
+        return before_to + to_value.encode("ascii") + after_to, closing
+
+    def build_message(self, sender, recipients, email_subject, email_body, encoded_attachments):
+        """
+        Build the message in SMTP wire format - only headers and body are serialized here, the pre-encoded attachments are spliced in
+        :param encoded_attachments: list of SpooledBuffer, serialized MIME parts as returned by encoded_attachments
+        :returns: generator of bytes chunks, the attachments being read from their buffers one chunk at a time
+        """
+        with METRICS.timer("build_message"):
+            head, closing = self.message_parts(sender, recipients, email_subject, email_body)
+        yield head
+        delimiter = to_smtp_wire_format("\n--" + self.boundary + "\n")
+        for encoded_part in encoded_attachments:
+            yield delimiter
+            yield from encoded_part.iter_chunks()
+        yield closing
+
+    def message_size(self, sender, recipients, email_subject, email_body, attachment_files):
+        """
+        Build the separate email of each recipient, without sending it
+        :returns: int, total size in bytes of the emails, in SMTP wire format
+        """
+        encoded_attachments = self.encoded_attachments(attachment_files)
+        # Attachments are already encoded, only their size is needed
+        attachments_size = sum(len(to_smtp_wire_format("\n--" + self.boundary + "\n")) + encoded_part.size for encoded_part in encoded_attachments)
+        total_size = 0
         for recipient in recipients:
-            self.channel.send(self.project_id, [recipient], email_subject, email_body, attachments=files, plain_text=self.plain_text, sender=sender_to_use)
+            head, closing = self.message_parts(sender, [recipient], email_subject, email_body)
+            total_size += len(head) + attachments_size + len(closing)
+        return total_size
+
+    def close_encoded_attachments(self):
+        for _, encoded_part in self.encoded_attachments_cache.values():
+            encoded_part.close()
+        self.encoded_attachments_cache = OrderedDict()
 
 
-class SmtpEmailClient(AbstractMessageClient):
+class SmtpEmailClient(MessageBuilder, AbstractMessageClient):
     """ Client for sending email - direct SMTP implementation
     :param plain_text: bool, wther the email client will interpret and send the emails body as plain text
     :param smtp_config: SmtpConfig, stmp config to use
+    :param pool_size: int, number of SMTP connections kept open - each can be used by a different thread at the same time
+    :param rate_limiter: AdaptiveRateLimiter shared by all connections, None for no limit
+    :param max_messages_per_connection: int, a connection is closed and reopened after this many messages - 0 for no limit
+    :param retry_policy: RetryPolicy for temporary (4xx) failures, None to never retry
+    :param message_cache_bytes: int, maximum size of the cache of serialized messages
     """
 
-    def __init__(self, plain_text, smtp_config):
+    def __init__(self, plain_text, smtp_config, pool_size=1, rate_limiter=None, max_messages_per_connection=0, retry_policy=None,
+                 message_cache_bytes=32 * 1024 * 1024):
         super().__init__(plain_text)
-        self.smtp = smtplib.SMTP(smtp_config.smtp_host, port=smtp_config.smtp_port)
         self.smtp_config = smtp_config
+        self.pool_size = max(1, pool_size)
+        self.rate_limiter = rate_limiter
+        self.max_messages_per_connection = max_messages_per_connection
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=0)
+        # Idle connections, ready to be used by a sending thread
+        self.idle_connections = queue.Queue()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.init_message_builder(message_cache_bytes)
 
         logging.info(f"Configured an STMP mail client with host: {smtp_config.smtp_host}, port: {smtp_config.smtp_port}, "
-                     f"tls? {smtp_config.smtp_use_tls}, auth? {smtp_config.smtp_use_auth}, plain_text? {self.plain_text}")
+                     f"tls? {smtp_config.smtp_use_tls}, auth? {smtp_config.smtp_use_auth}, plain_text? {self.plain_text}, "
+                     f"connections: {self.pool_size}, max rate: {rate_limiter.max_rate if rate_limiter else 'none'}, "
+                     f"max messages per connection: {max_messages_per_connection or 'none'}, retries: {self.retry_policy.max_retries}")
 
-
-    def login(self):
+    def open_connection(self):
+        """
+        Open a new SMTP connection, starting TLS and authenticating it as configured
+        :returns: smtplib.SMTP
+        """
+        smtp = smtplib.SMTP(self.smtp_config.smtp_host, port=self.smtp_config.smtp_port)
         # Use TLS if set
         if self.smtp_config.smtp_use_tls:
-            self.smtp.starttls()
+            smtp.starttls(context=starttls_context())
             logging.info("SMTP TLS started")
         # Use credentials if set
         if self.smtp_config.smtp_use_auth:
-            self.smtp.login(str(self.smtp_config.smtp_user), str(self.smtp_config.smtp_pass))
+            smtp.login(str(self.smtp_config.smtp_user), str(self.smtp_config.smtp_pass))
             logging.info(f"Authenticated against STMP mail client")
+        return smtp
 
+    def login(self):
+        for _ in range(self.pool_size):
+            connection = PooledConnection(self.open_connection())
+            with self.connections_lock:
+                self.connections.append(connection)
+            self.idle_connections.put(connection)
 
+    def reconnect(self, connection):
+        """ Replace the SMTP session of a pooled connection by a new one """
+        try:
+            connection.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.smtp.close()
+        connection.smtp = self.open_connection()
+        connection.messages_sent = 0
 
-    def attachments_to_mime(self, attachment_files):
+    @contextmanager
+    def connection(self):
         """
-        :param attachment_files:attachment_files as list of AttachmentFile
-        :returns: the MIME parts, list of MIMEBase
+        Borrow an idle connection for the duration of a send, waiting if they are all in use.
+        The connection is renewed first if it reached the maximum number of messages, or was closed by the server
         """
-        attachment_mimes = [];
-        for attachment_file in attachment_files:
-            if attachment_file.mime_type == "application":
-                mime_app = MIMEApplication(attachment_file.data, _subtype=attachment_file.mime_subtype)
-            elif attachment_file.mime_type == "text":
-                mime_app = MIMEText(attachment_file.data, _subtype=attachment_file.mime_subtype, _charset="utf-8")
-            else:
-                raise Exception(f'Cannot handle mime type {attachment_file.mime_type}')
-            mime_app.add_header("Content-Disposition", 'attachment', filename=attachment_file.file_name)
-            attachment_mimes.append(mime_app)
-        return attachment_mimes
+        connection = self.idle_connections.get()
+        try:
+            if connection.smtp.sock is None:
+                logging.info("SMTP connection was closed, reconnecting")
+                self.reconnect(connection)
+            elif self.max_messages_per_connection and connection.messages_sent >= self.max_messages_per_connection:
+                logging.info(f"SMTP connection sent {connection.messages_sent} messages, reconnecting")
+                self.reconnect(connection)
+            yield connection
+        finally:
+            self.idle_connections.put(connection)
 
-    def send_single_email(self, sender, recipients, email_subject, email_body, attachment_mimes):
+    @timed("smtp_send")
+    def send_single_email(self, sender, recipients, email_subject, email_body, encoded_attachments):
         """
         Sends a separate email to each recipient
         :param sender: sender email, str - is ignored if a sender configured for the channel
         :param recipients: recipients email addresses, list
         :param email_subject: str
         :param email_body: body of either plain text or html, str
-        :param attachment_mimes, list of MIMEBase
+        :param encoded_attachments: list of SpooledBuffer, serialized MIME parts as returned by encoded_attachments
         """
-        msg = MIMEMultipart()
-        msg["From"] = sender
-        msg["To"] = ",".join(recipients)
-        msg["Subject"] = email_subject
-        body_encoding = "utf-8"
-        text_type = 'plain' if self.plain_text else 'html'
-        msg.attach(MIMEText(email_body, text_type, body_encoding))
-        for mime_app in attachment_mimes:
-            msg.attach(mime_app)
-        self.smtp.sendmail(sender, recipients, msg.as_string())
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                message_chunks = self.build_message(sender, recipients, email_subject, email_body, encoded_attachments)
+                with self.connection() as connection:
+                    connection.messages_sent += 1
+                    send_message_chunks(connection.smtp, sender, recipients, message_chunks)
+            except Exception as exp:
+                if not is_temporary_smtp_error(exp):
+                    raise
+                if self.rate_limiter:
+                    self.rate_limiter.on_temporary_failure()
+                if attempt >= self.retry_policy.max_retries:
+                    raise
+                delay = self.retry_policy.backoff_delay(attempt)
+                attempt += 1
+                logging.warning(f"Temporary failure sending to {recipients}: {exp} - retry {attempt} in {delay:.1f}s")
+                METRICS.increment("smtp_retries")
+                time.sleep(delay)
+                continue
+            if self.rate_limiter:
+                self.rate_limiter.on_success()
+            return
 
     def send_email(self, sender, recipients, email_subject, email_body, attachment_files):
-        attachment_mimes = self.attachments_to_mime(attachment_files)
+        encoded_attachments = self.encoded_attachments(attachment_files)
         for recipient in recipients:
-            self.send_single_email(sender, [recipient], email_subject, email_body, attachment_mimes)
+            self.send_single_email(sender, [recipient], email_subject, email_body, encoded_attachments)
 
     def quit(self):
         """ Do any disconnection needed"""
-        self.smtp.quit()
+        self.close_encoded_attachments()
+        for connection in self.connections:
+            try:
+                connection.smtp.quit()
+            except (smtplib.SMTPException, OSError) as exp:
+                logging.warning(f"Could not cleanly close SMTP connection: {exp}")
+        self.connections = []
+
+
+class SmtpJob:
+    """ Message waiting for a connection of an AsyncSmtpEmailClient, the future is resolved once the server accepted or refused it """
+    def __init__(self, sender, recipients, message_chunks, future):
+        self.sender = sender
+        self.recipients = recipients
+        # Built up front, so a recipient that cannot be written in an SMTP command fails before reaching a connection
+        self.envelope = envelope_bytes(sender, recipients)
+        self.message_chunks = message_chunks
+        self.future = future
+
+
+class AsyncSmtpEmailClient(SmtpEmailClient):
+    """ Client for sending email - direct SMTP implementation running on an asyncio event loop, in a thread of its own.
+    Messages are built as by SmtpEmailClient, but any number of them can be in flight (see submit_email) over the pool_size
+    connections, without a thread per message. When the server supports pipelining, the MAIL FROM, RCPT TO and DATA commands of
+    a message are sent together, right after the content of the previous message - each message then costs a single round trip
+    Parameters are those of SmtpEmailClient
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.loop_thread = None
+        # Created within the event loop, asyncio queues are bound to the loop of their creation in Python < 3.10
+        self.jobs = None
+        self.connection_tasks = []
+
+    def run(self, coroutine):
+        """ Run a coroutine on the event loop and wait for its result, from any other thread """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def login(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name="smtp-event-loop", daemon=True)
+        self.loop_thread.start()
+        # Looked up once, rather than for each connection as smtplib does
+        local_hostname = socket.getfqdn()
+        self.run(self.open_connections(local_hostname))
+
+    async def open_connections(self, local_hostname):
+        self.jobs = asyncio.Queue()
+        connections = [AsyncSmtpConnection(self.smtp_config, local_hostname) for _ in range(self.pool_size)]
+        try:
+            await asyncio.gather(*(connection.open() for connection in connections))
+        except Exception:
+            for connection in connections:
+                connection.close()
+            raise
+        self.connections = connections
+        self.connection_tasks = [asyncio.ensure_future(self.connection_worker(connection)) for connection in connections]
+        logging.info(f"Opened {len(connections)} asyncio SMTP connection(s), pipelining? {connections[0].pipelining}")
+
+    def needs_reconnect(self, connection):
+        return not connection.is_open() or \
+            (self.max_messages_per_connection and connection.messages_sent >= self.max_messages_per_connection)
+
+    async def prepare_connection(self, connection):
+        """ Renew the SMTP session if it reached the maximum number of messages, or was closed by the server """
+        if not self.needs_reconnect(connection):
+            return
+        if connection.is_open():
+            logging.info(f"SMTP connection sent {connection.messages_sent} messages, reconnecting")
+            try:
+                await connection.quit()
+            except (smtplib.SMTPException, OSError):
+                connection.close()
+        else:
+            logging.info("SMTP connection was closed, reconnecting")
+        connection.messages_sent = 0
+        await connection.open()
+
+    async def connection_worker(self, connection):
+        """ Send the messages of the job queue over one connection, one transaction at a time, until a None job """
+        job = await self.jobs.get()
+        envelope_written = False
+        while job is not None:
+            next_job = None
+            took_next_job = False
+            try:
+                if not envelope_written:
+                    await self.prepare_connection(connection)
+                    if connection.pipelining:
+                        connection.write(job.envelope)
+                if connection.pipelining:
+                    await connection.read_envelope_replies(job.sender, job.recipients)
+                else:
+                    await connection.send_envelope(job.sender, job.recipients)
+                connection.messages_sent += 1
+                await connection.write_content(job.message_chunks)
+                # The envelope of the next message goes right after the content, so both replies come back in the same round trip
+                if connection.pipelining and not self.jobs.empty() and not self.needs_reconnect(connection):
+                    next_job = self.jobs.get_nowait()
+                    took_next_job = True
+                    if next_job is not None:
+                        connection.write(next_job.envelope)
+                await connection.read_data_reply()
+            except Exception as exp:
+                # Unless the server refused the message with a reply, the state of the session is unknown
+                if not isinstance(exp, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)):
+                    connection.close()
+                if not job.future.done():
+                    job.future.set_exception(exp)
+            else:
+                if not job.future.done():
+                    job.future.set_result(None)
+            # Replies to an envelope already written are still to be read, unless the connection was lost meanwhile
+            envelope_written = next_job is not None and connection.is_open()
+            job = next_job if took_next_job else await self.jobs.get()
+
+    async def acquire_rate(self):
+        while True:
+            wait_time = self.rate_limiter.try_acquire()
+            if not wait_time:
+                return
+            await asyncio.sleep(wait_time)
+
+    async def send_single_email_async(self, sender, recipients, email_subject, email_body, encoded_attachments):
+        """ Coroutine equivalent of SmtpEmailClient.send_single_email, the connection being found by the job queue """
+        with METRICS.timer("smtp_send"):
+            attempt = 0
+            while True:
+                if self.rate_limiter:
+                    await self.acquire_rate()
+                try:
+                    job = SmtpJob(sender, recipients, self.build_message(sender, recipients, email_subject, email_body, encoded_attachments),
+                                  self.loop.create_future())
+                    await self.jobs.put(job)
+                    await job.future
+                except Exception as exp:
+                    if not is_temporary_smtp_error(exp):
+                        raise
+                    if self.rate_limiter:
+                        self.rate_limiter.on_temporary_failure()
+                    if attempt >= self.retry_policy.max_retries:
+                        raise
+                    delay = self.retry_policy.backoff_delay(attempt)
+                    attempt += 1
+                    logging.warning(f"Temporary failure sending to {recipients}: {exp} - retry {attempt} in {delay:.1f}s")
+                    METRICS.increment("smtp_retries")
+                    await asyncio.sleep(delay)
+                    continue
+                if self.rate_limiter:
+                    self.rate_limiter.on_success()
+                return
+
+    async def send_to_each_recipient(self, sender, recipients, email_subject, email_body, encoded_attachments):
+        await asyncio.gather(*(self.send_single_email_async(sender, [recipient], email_subject, email_body, encoded_attachments)
+                               for recipient in recipients))
+
+    def submit_email(self, sender, recipients, email_subject, email_body, attachment_files):
+        """
+        Start sending a separate email to each recipient, without waiting for them to be sent
+        :returns: concurrent.futures.Future, done once all the emails are sent - its exception is the first failure, if any
+        """
+        encoded_attachments = self.encoded_attachments(attachment_files)
+        return asyncio.run_coroutine_threadsafe(
+            self.send_to_each_recipient(sender, recipients, email_subject, email_body, encoded_attachments), self.loop)
+
+    def send_email(self, sender, recipients, email_subject, email_body, attachment_files):
+        self.submit_email(sender, recipients, email_subject, email_body, attachment_files).result()
+
+    async def close_connections(self):
+        for _ in self.connection_tasks:
+            await self.jobs.put(None)
+        await asyncio.gather(*self.connection_tasks)
+        for connection in self.connections:
+            try:
+                await connection.quit()
+            except (smtplib.SMTPException, OSError) as exp:
+                logging.warning(f"Could not cleanly close SMTP connection: {exp}")
+        self.connections = []
+        self.connection_tasks = []
+
+    def quit(self):
+        """ Do any disconnection needed, then stop the event loop """
+        self.close_encoded_attachments()
+        if self.loop is None:
+            return
+        self.run(self.close_connections())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.loop = None
+
+
+class DryRunEmailClient(MessageBuilder, AbstractMessageClient):
+    """ Null transport for dry runs: each message is built as SmtpEmailClient would send it, then dropped - only its size is kept
+    :param plain_text: bool, whether the body is sent as plain text
+    :param message_cache_bytes: int, maximum size of the cache of serialized messages
+    """
+    def __init__(self, plain_text, message_cache_bytes=32 * 1024 * 1024):
+        super().__init__(plain_text)
+        self.init_message_builder(message_cache_bytes)
+        logging.info(f"Configured a dry run mail client, no email is sent - plain_text? {self.plain_text}")
+
+    @timed("dry_run_build")
+    def message_size(self, sender, recipients, email_subject, email_body, attachment_files):
+        total_size = super().message_size(sender, recipients, email_subject, email_body, attachment_files)
+        METRICS.increment("dry_run_messages", len(recipients))
+        METRICS.increment("dry_run_bytes", total_size)
+        return total_size
+
+    def send_email(self, sender, recipients, email_subject, email_body, attachment_files):
+        self.message_size(sender, recipients, email_subject, email_body, attachment_files)
+
+    def quit(self):
+        self.close_encoded_attachments()
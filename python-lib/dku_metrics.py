@@ -0,0 +1,171 @@
+# Lightweight timing and counters of the hot path, to see where the time of a run goes
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in milliseconds - from 10 microseconds, doubling up to about 20 minutes
+BUCKET_BOUNDS_MS = [0.01 * 2 ** i for i in range(28)]
+
+
+class Histogram:
+    """ Thread-safe histogram of durations in milliseconds, with exponential buckets """
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def record(self, value_ms):
+        bucket = bisect.bisect_left(BUCKET_BOUNDS_MS, value_ms)
+        with self.lock:
+            self.bucket_counts[bucket] += 1
+            self.count += 1
+            self.total += value_ms
+            self.min = value_ms if self.min is None else min(self.min, value_ms)
+            self.max = value_ms if self.max is None else max(self.max, value_ms)
+
+    def merge(self, state):
+        """ :param state: tuple (bucket_counts, count, total, min, max) of another histogram, as returned by state() """
+        bucket_counts, count, total, min_value, max_value = state
+        if count == 0:
+            return
+        with self.lock:
+            self.bucket_counts = [mine + theirs for mine, theirs in zip(self.bucket_counts, bucket_counts)]
+            self.count += count
+            self.total += total
+            self.min = min_value if self.min is None else min(self.min, min_value)
+            self.max = max_value if self.max is None else max(self.max, max_value)
+
+    def state(self):
+        with self.lock:
+            return list(self.bucket_counts), self.count, self.total, self.min, self.max
+
+    def percentile(self, fraction):
+        """ :returns: upper bound of the bucket holding the given fraction of the values (capped by the max), in ms """
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            rank = fraction * self.count
+            seen = 0
+            for bucket, bucket_count in enumerate(self.bucket_counts):
+                seen += bucket_count
+                if seen >= rank and bucket_count > 0:
+                    return min(BUCKET_BOUNDS_MS[bucket] if bucket < len(BUCKET_BOUNDS_MS) else self.max, self.max)
+            return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total, 3),
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "min_ms": round(self.min or 0.0, 3),
+            "p50_ms": round(self.percentile(0.5), 3),
+            "p90_ms": round(self.percentile(0.9), 3),
+            "p99_ms": round(self.percentile(0.99), 3),
+            "max_ms": round(self.max or 0.0, 3),
+        }
+
+
+class MetricsRegistry:
+    """ Named duration histograms and counters """
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def record(self, name, duration_ms):
+        self.histogram(name).record(duration_ms)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, 1000 * (time.perf_counter() - start))
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def counter(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def snapshot(self):
+        """ :returns: picklable copy of the histograms and counters, to be merged into the registry of another process """
+        with self.lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+        return {name: histogram.state() for name, histogram in histograms.items()}, counters
+
+    def merge(self, snapshot):
+        histogram_states, counters = snapshot
+        for name, histogram_state in histogram_states.items():
+            self.histogram(name).merge(histogram_state)
+        for name, value in counters.items():
+            self.increment(name, value)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def summary_records(self):
+        """ :returns: list of dicts, one per stage with its duration statistics, then one per counter """
+        records = [dict(stage=name, **histogram.summary()) for name, histogram in sorted(self.histograms.items())]
+        records += [{"stage": name, "count": value} for name, value in sorted(self.counters.items())]
+        return records
+
+    def log_summary(self):
+        for record in self.summary_records():
+            if "total_ms" in record:
+                logging.info(f"Timing {record['stage']}: {record['count']} calls, total {record['total_ms'] / 1000:.2f}s, "
+                             f"mean {record['mean_ms']:.2f}ms, p50 {record['p50_ms']:.2f}ms, p90 {record['p90_ms']:.2f}ms, "
+                             f"p99 {record['p99_ms']:.2f}ms, max {record['max_ms']:.2f}ms")
+            else:
+                logging.info(f"Counter {record['stage']}: {record['count']}")
+
+
+# Registry used by the plugin code
+METRICS = MetricsRegistry()
+
+# Schema of the metrics output dataset, matching summary_records
+METRICS_SCHEMA = [{'name': 'stage', 'type': 'string'}, {'name': 'count', 'type': 'bigint'}] + \
+                 [{'name': name, 'type': 'double'} for name in ["total_ms", "mean_ms", "min_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"]]
+
+
+def timed(name):
+    """ Decorator recording the duration of each call of the function in METRICS under the given name """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(iterable, name):
+    """ Generator yielding the items of iterable, recording the time taken to get each one in METRICS under the given name """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        METRICS.record(name, 1000 * (time.perf_counter() - start))
+        yield item
@@ -0,0 +1,121 @@
+# Client-side rate limiting and retries, to stay under the limits of SMTP relays instead of hitting them
+import logging
+import random
+import smtplib
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: acquire() waits until a token is available, tokens are refilled at `rate` per second
+    :param rate: float, tokens per second
+    :param capacity: float, maximum number of tokens stored (size of the bursts allowed), defaults to one second worth of tokens
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def try_acquire(self):
+        """ Take a token if one is available, without waiting :returns: 0 if a token was taken, else the seconds until one is """
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait_time = self.try_acquire()
+            if not wait_time:
+                return
+            time.sleep(wait_time)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = float(rate)
+            # Do not allow a burst bigger than one second at the new rate
+            self.tokens = min(self.tokens, max(1.0, self.rate))
+
+
+class AdaptiveRateLimiter:
+    """
+    Rate limiter that slows down when the server reports temporary failures (halving the rate, at most once per cooldown period)
+    and speeds up again progressively on successes, up to max_rate - so throughput settles just under the server limit
+    :param max_rate: float, maximum messages per second
+    :param min_rate: float, rate never gone under, defaults to 5% of max_rate
+    :param cooldown: float, minimum seconds between two slow downs, so a burst of failures only counts once
+    """
+    def __init__(self, max_rate, min_rate=None, cooldown=1.0):
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate) if min_rate else self.max_rate / 20
+        self.cooldown = cooldown
+        self.bucket = TokenBucket(self.max_rate)
+        self.last_slow_down = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def acquire(self):
+        self.bucket.acquire()
+
+    def try_acquire(self):
+        """ Non blocking acquire, for callers that wait by other means (e.g. an event loop), see TokenBucket.try_acquire """
+        return self.bucket.try_acquire()
+
+    def on_success(self):
+        if self.bucket.rate < self.max_rate:
+            with self.lock:
+                self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.max_rate / 100))
+
+    def on_temporary_failure(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_slow_down < self.cooldown:
+                return
+            self.last_slow_down = now
+            new_rate = max(self.min_rate, self.bucket.rate / 2)
+            self.bucket.set_rate(new_rate)
+        logging.warning(f"Server reported a temporary failure, slowing down to {new_rate:.2f} messages/s")
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter
+    :param max_retries: int, number of retries after the first attempt
+    :param base_delay: float, seconds, delay ceiling for the first retry - doubled for each following one
+    :param max_delay: float, seconds, maximum delay ceiling
+    """
+    def __init__(self, max_retries=3, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max(0, max_retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff_delay(self, attempt):
+        """ :param attempt: int, 0 for the first retry """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+def is_temporary_smtp_error(exp):
+    """
+    :param exp: exception raised while sending
+    :returns: True if the error is transient (4xx SMTP reply, or connection dropped by the server) and the send can be retried
+    """
+    if isinstance(exp, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exp.recipients.values()]
+        return len(codes) > 0 and all(400 <= code < 500 for code in codes)
+    if isinstance(exp, smtplib.SMTPResponseException):
+        return 400 <= exp.smtp_code < 500
+    return isinstance(exp, smtplib.SMTPServerDisconnected)
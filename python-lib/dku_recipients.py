@@ -0,0 +1,163 @@
+# Parsing and checks of the recipient addresses, done before any email is rendered or sent
+import hashlib
+import json
+import logging
+import re
+import threading
+
+# Key of a contact dict holding the claims of the duplicate filter for the row, from claim_row until settle_rows
+DUPLICATE_CLAIMS_KEY = "__sendmail_duplicate_claims"
+
+# Deliberately permissive check of an address: something@domain, with no whitespace nor characters that are
+# special in address headers - quoted local parts are not supported
+ADDRESS_REGEX = re.compile(r'[^@\s<>(),;:"\[\]\\]+@[^@\s<>(),;:"\[\]\\.]+(?:\.[^@\s<>(),;:"\[\]\\.]+)*')
+# Address within angle brackets, in the `Display Name <name@place.com>` form
+ANGLE_ADDRESS_REGEX = re.compile(r'<([^<>]*)>$')
+
+
+# Takes a string and returns a list of one or more address values
+def parse_recipients(recipients):
+    try:
+        # JSON array case
+        value = json.loads(recipients)
+        if isinstance(value, list):
+            return value
+    except json.decoder.JSONDecodeError:
+        pass
+    # Other cases - either a single value or comma separated string `name@place.com, name2@place.com`
+    return recipients.split(",")
+
+
+def bare_address(address):
+    """ :returns: str, the address without its display name if it has one """
+    match = ANGLE_ADDRESS_REGEX.search(address)
+    return match.group(1).strip() if match else address
+
+
+def address_key(address):
+    """ :returns: str, the bare address of a recipient, lower cased - recipients with the same key get the same mailbox """
+    return bare_address(address.strip()).lower()
+
+
+def check_recipients(recipients):
+    """
+    Parse, normalize and validate the recipients of one row
+    :param recipients: value of the recipient column - single address, comma separated addresses or JSON array
+    :returns: tuple (valid_addresses, invalid_addresses). Addresses are stripped of whitespace, empty ones are dropped and
+              repeated ones (ignoring case) are only kept once
+    """
+    if not isinstance(recipients, str):
+        # Missing values (None or NaN)
+        recipients = "" if recipients is None or recipients != recipients else str(recipients)
+    is_json = recipients.lstrip().startswith("[")
+    if not is_json and "," not in recipients:
+        # Fast path for the usual case of a single address
+        address = recipients.strip()
+        if not address:
+            return [], []
+        return ([address], []) if ADDRESS_REGEX.fullmatch(bare_address(address)) else ([], [address])
+    valid_addresses = []
+    invalid_addresses = []
+    keys = set()
+    for address in (parse_recipients(recipients) if is_json else recipients.split(",")):
+        address = str(address).strip()
+        bare = bare_address(address)
+        if not address or bare.lower() in keys:
+            continue
+        keys.add(bare.lower())
+        (valid_addresses if ADDRESS_REGEX.fullmatch(bare) else invalid_addresses).append(address)
+    return valid_addresses, invalid_addresses
+
+
+class DuplicateClaim:
+    """ A (recipient, email content) pair claimed by the row sending it - delivered is None until the outcome of its send is known """
+    __slots__ = ("recipient", "digest", "delivered")
+
+    def __init__(self, recipient, digest):
+        self.recipient = recipient
+        self.digest = digest
+        self.delivered = None
+
+
+class DuplicateFilter:
+    """
+    Thread-safe record of the (recipient, email content) pairs sent during the run, so that a recipient listed in
+    several rows with an identical email gets it only once. Only a 16 bytes digest is kept per delivered pair.
+    A pair is claimed by the first row sending it, and only recorded as sent once that row reports it delivered - if the send
+    fails, the next row with the same pair sends it again.
+    Rows must be claimed in input order (claim_row), then settled in input order once sent (settle_rows): a row skipped as a
+    duplicate is then always settled after the row sending its email.
+    """
+    def __init__(self):
+        self.seen = set()
+        # Claims of the pairs being sent, by digest
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.duplicates = 0
+
+    def claim_recipients(self, recipients, content_parts):
+        """
+        :param recipients: list of addresses of an email
+        :param content_parts: tuple of str identifying the content of the email (sender, subject, body, attachments...)
+        :returns: tuple (claims, duplicate_claims), lists of DuplicateClaim - claims of the recipients to send the email to, then
+                  the claims of the previous rows already sending the same email to the other recipients
+        """
+        content_hash = hashlib.sha1(json.dumps(content_parts, default=str).encode("utf-8")).digest()
+        pair_digests = [hashlib.blake2b(content_hash + address_key(recipient).encode("utf-8"), digest_size=16).digest()
+                        for recipient in recipients]
+        claims = []
+        duplicate_claims = []
+        with self.lock:
+            for recipient, pair_digest in zip(recipients, pair_digests):
+                if pair_digest in self.seen:
+                    # Already delivered
+                    self.duplicates += 1
+                elif pair_digest in self.pending:
+                    self.duplicates += 1
+                    duplicate_claims.append(self.pending[pair_digest])
+                else:
+                    claim = DuplicateClaim(recipient, pair_digest)
+                    self.pending[pair_digest] = claim
+                    claims.append(claim)
+        return claims, duplicate_claims
+
+    def claim_row(self, contact_dict, recipients, content_parts):
+        """
+        claim_recipients for the email of a contact row, the claims are kept in the row for settle_rows
+        :returns: list of the recipients to send the email to
+        """
+        claims, duplicate_claims = self.claim_recipients(recipients, content_parts)
+        contact_dict[DUPLICATE_CLAIMS_KEY] = (claims, duplicate_claims)
+        return [claim.recipient for claim in claims]
+
+    def settle_rows(self, contact_dicts, is_delivered):
+        """
+        Record the outcome of the emails claimed by each row, once sent. A row skipped as a duplicate of an email that failed
+        is marked as failed too, its recipient did not get the email.
+        :param contact_dicts: iterable of the contact dicts in input order, with their sendmail status set
+        :param is_delivered: function called with a contact dict of a row that did not succeed and one of its recipients, returns
+                             True if the email was delivered to that recipient anyway (rows sent one recipient at a time)
+        :returns: generator of the same contact dicts
+        """
+        for contact_dict in contact_dicts:
+            claims, duplicate_claims = contact_dict.pop(DUPLICATE_CLAIMS_KEY, ((), ()))
+            succeeded = contact_dict['sendmail_status'] in ('SUCCESS', 'DRY_RUN')
+            for claim in claims:
+                self.settle(claim, succeeded or is_delivered(contact_dict, claim.recipient))
+            undelivered = [claim.recipient for claim in duplicate_claims if not claim.delivered]
+            if undelivered:
+                contact_dict['sendmail_status'] = 'FAILED'
+                contact_dict['sendmail_error'] = f"Not sent to {', '.join(undelivered)}: the same email failed for a previous row"
+            yield contact_dict
+
+    def settle(self, claim, delivered):
+        """ Record the outcome of the send of a claimed pair, a pair not delivered can be claimed again """
+        with self.lock:
+            if self.pending.get(claim.digest) is claim:
+                del self.pending[claim.digest]
+            if delivered:
+                self.seen.add(claim.digest)
+        claim.delivered = delivered
+
+    def log_summary(self):
+        logging.info(f"{self.duplicates} duplicate recipient(s) skipped, {len(self.seen)} distinct (recipient, email) pairs")
@@ -0,0 +1,147 @@
+# Checkpoint journal, so that a failed run can be resumed without sending the same emails again
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Output column holding the key identifying each contact row in the journal
+ROW_KEY_COLUMN = "sendmail_row_key"
+# Statuses of the rows not processed again when resuming - skipped rows and rows with invalid recipients would end the same way
+FINAL_STATUSES = ("SUCCESS", "SKIPPED", "INVALID")
+
+
+def compute_row_key(contact_dict, key_column=None):
+    """
+    :param contact_dict: dict of column name to value, the contact row
+    :param key_column: str, column whose value identifies the row - if None the key is a hash of the whole row
+    :returns: str
+    """
+    if key_column:
+        return str(contact_dict.get(key_column))
+    row_json = json.dumps(contact_dict, sort_keys=True, default=str)
+    return hashlib.sha1(row_json.encode("utf-8")).hexdigest()
+
+
+def with_row_keys(contact_dicts, key_column=None):
+    """
+    Set the ROW_KEY_COLUMN of each contact row - repeated keys (duplicate rows) get a `#<occurrence>` suffix so each row has its own key
+    :param contact_dicts: iterable of contact dicts
+    :param key_column: str, column whose value identifies the row - if None the key is a hash of the whole row
+    :returns: generator of the same contact dicts
+    """
+    occurrences = {}
+    for contact_dict in contact_dicts:
+        row_key = compute_row_key(contact_dict, key_column)
+        occurrence = occurrences.get(row_key, 0) + 1
+        occurrences[row_key] = occurrence
+        contact_dict[ROW_KEY_COLUMN] = row_key if occurrence == 1 else f"{row_key}#{occurrence}"
+        yield contact_dict
+
+
+class SendJournal:
+    """
+    Append-only journal (JSON lines) of the emails delivered, and of the rows completed with their output values.
+    Entries are flushed to disk (fsync) every fsync_every entries or fsync_interval seconds.
+    :param path: str, path of the journal file
+    :param resume: bool, whether to load the entries of a previous run - if False the journal is started afresh
+    :param fsync_every: int, maximum number of entries written between two fsync
+    :param fsync_interval: float, maximum number of seconds between two fsync
+    """
+    def __init__(self, path, resume, fsync_every=100, fsync_interval=5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        # (row key, recipient) pairs already delivered
+        self.delivered = set()
+        # row key -> output row, for rows that completed with a final status
+        self.completed_rows = {}
+        if resume:
+            self.load()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not resume:
+            open(path, "w").close()
+        # Always appended to, one line at a time, so that several processes can write to the journal at the same time
+        self.file = open(path, "a", encoding="utf-8", buffering=1)
+        if resume and not self.ends_with_newline():
+            # End the line cut short by the previous run, or the next entry would be appended to it and ignored as well
+            self.file.write("\n")
+        self.lock = threading.Lock()
+        self.unsynced_entries = 0
+        self.last_sync_time = time.time()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            logging.info(f"No journal found at {self.path}, starting from the beginning")
+            return
+        ignored_lines = 0
+        with open(self.path, encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Typically the last line, if the previous run stopped while writing it
+                    ignored_lines += 1
+                    continue
+                if entry.get("type") == "delivered":
+                    self.delivered.add((entry["key"], entry["recipient"]))
+                elif entry.get("type") == "row":
+                    if entry["row"].get("sendmail_status") in FINAL_STATUSES:
+                        self.completed_rows[entry["key"]] = entry["row"]
+                    else:
+                        # A failed row is sent again, apart from the recipients it was delivered to
+                        self.completed_rows.pop(entry["key"], None)
+        logging.info(f"Loaded journal {self.path}: {len(self.delivered)} emails delivered, {len(self.completed_rows)} rows completed"
+                     + (f", {ignored_lines} unreadable lines ignored" if ignored_lines else ""))
+
+    def ends_with_newline(self):
+        """ :returns: bool, whether the journal file is empty or its last line is complete """
+        with open(self.path, "rb") as journal_file:
+            journal_file.seek(0, os.SEEK_END)
+            if journal_file.tell() == 0:
+                return True
+            journal_file.seek(-1, os.SEEK_END)
+            return journal_file.read(1) == b"\n"
+
+    def reopen_after_fork(self):
+        """ To be called in a forked process before writing, so it does not share the file object of the parent process """
+        self.file = open(self.path, "a", encoding="utf-8", buffering=1)
+        self.lock = threading.Lock()
+        self.unsynced_entries = 0
+
+    def completed_row(self, row_key):
+        """ :returns: the output row recorded for this row key if it was completed in a previous run, else None """
+        return self.completed_rows.get(row_key)
+
+    def is_delivered(self, row_key, recipient):
+        return (row_key, recipient) in self.delivered
+
+    def record_delivery(self, row_key, recipient):
+        self.write({"type": "delivered", "key": row_key, "recipient": recipient})
+        # Also known during this run, e.g. by the duplicate filter for a row that failed for its other recipients
+        self.delivered.add((row_key, recipient))
+
+    def record_row(self, row_key, row):
+        self.write({"type": "row", "key": row_key, "row": row})
+
+    def write(self, entry):
+        line = json.dumps(entry, default=str) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.unsynced_entries += 1
+            if self.unsynced_entries >= self.fsync_every or time.time() - self.last_sync_time >= self.fsync_interval:
+                self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced_entries = 0
+        self.last_sync_time = time.time()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
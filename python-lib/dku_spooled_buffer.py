@@ -0,0 +1,90 @@
+import io
+import os
+import tempfile
+
+# Buffers keep up to this many bytes in memory before moving their content to a temporary file
+DEFAULT_MAX_MEMORY_SIZE = 16 * 1024 * 1024
+# Size of the chunks read from / written to buffers - a multiple of 57 so that base64 of a chunk is made of whole 76 chars lines
+CHUNK_SIZE = 57 * 16 * 1024
+
+
+class SpooledBuffer:
+    """
+    Append-only byte buffer held in memory up to max_memory_size bytes, then spilled to a temporary file.
+    Once written, it can be read by several threads at the same time (reads do not share a file position)
+    :param max_memory_size: int, maximum number of bytes kept in memory
+    """
+    def __init__(self, max_memory_size=DEFAULT_MAX_MEMORY_SIZE):
+        self.max_memory_size = max_memory_size
+        self.memory = io.BytesIO()
+        self.file = None
+        self.size = 0
+        # Largest amount of the content held in memory at any one time
+        self.peak_memory_size = 0
+        self.needs_flush = False
+
+    def write(self, data):
+        if self.file is None and self.size + len(data) > self.max_memory_size:
+            # Roll over to disk
+            self.file = tempfile.TemporaryFile()
+            self.file.write(self.memory.getbuffer())
+            self.memory = None
+        if self.file is None:
+            self.memory.write(data)
+            self.peak_memory_size = max(self.peak_memory_size, self.size + len(data))
+        else:
+            self.file.write(data)
+            self.needs_flush = True
+            self.peak_memory_size = max(self.peak_memory_size, len(data))
+        self.size += len(data)
+
+    def is_in_memory(self):
+        return self.file is None
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """
+        :param chunk_size: int, maximum size of each chunk
+        :returns: generator of bytes chunks of the content
+        """
+        if self.file is None:
+            view = self.memory.getbuffer()
+            try:
+                for offset in range(0, self.size, chunk_size):
+                    yield bytes(view[offset:offset + chunk_size])
+            finally:
+                view.release()
+        else:
+            if self.needs_flush:
+                self.file.flush()
+                self.needs_flush = False
+            fd = self.file.fileno()
+            for offset in range(0, self.size, chunk_size):
+                yield os.pread(fd, min(chunk_size, self.size - offset), offset)
+
+    def read_all(self):
+        """ :returns: the whole content as bytes - only use this when the content is known to fit in memory """
+        if self.file is None:
+            return self.memory.getvalue()
+        return b"".join(self.iter_chunks())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.memory = io.BytesIO()
+        self.size = 0
+
+
+def spool_stream(stream, max_memory_size=DEFAULT_MAX_MEMORY_SIZE):
+    """
+    Copy a readable binary stream into a SpooledBuffer, one chunk at a time
+    :param stream: file-like object with a read(size) method
+    :returns: SpooledBuffer
+    """
+    buffer = SpooledBuffer(max_memory_size)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer.write(chunk)
+    return buffer
@@ -1,7 +1,148 @@
 import logging
+import threading
+from collections import OrderedDict
+from dku_metrics import timed
+from dku_email_client import base64_encoded_size
 
+# Name under which attachments data is made available to the body template
+ATTACHMENTS_VARIABLE = "attachments"
+# Allowance for the headers and MIME boundaries of a message, in bytes, when estimating its size
+MESSAGE_HEADERS_SIZE = 2048
 
+
+class CompiledTemplate:
+    """
+    JINJA template compiled once per run, with the variables it references found by static analysis so that:
+     - a template referencing no variable is rendered only once
+     - only the referenced columns are passed to JINJA (no copy of the whole row)
+     - outputs are cached (LRU) by the values of the referenced columns, so rows with the same inputs reuse the rendered text
+    :param jinja_env: jinja2.Environment used to compile the template
+    :param source: str, template source
+    :param cache_size: int, maximum number of rendered outputs kept - 0 disables the cache
+    """
+    def __init__(self, jinja_env, source, cache_size=1000):
+        # Imported here, so that runs without templates do not load JINJA
+        from jinja2 import meta
+        ast = jinja_env.parse(source)
+        self.template = jinja_env.from_string(ast)
+        self.variables = meta.find_undeclared_variables(ast)
+        self.attachment_references = find_attribute_references(ast, ATTACHMENTS_VARIABLE)
+        # Variables taken from the contact row - sorted so that they give a stable cache key
+        self.row_variables = sorted(self.variables - {ATTACHMENTS_VARIABLE})
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.static_output = None
+        self.warned_about_attachments_column = False
+
+    def uses_attachments(self):
+        return ATTACHMENTS_VARIABLE in self.variables
+
+    def is_static(self):
+        return len(self.variables) == 0
+
+    def render(self, contact_dict, attachments_templating_dict=None):
+        """
+        :param contact_dict: dict of column name to value, the contact row
+        :param attachments_templating_dict: dict returned by attachments_template_dict, only used if the template references attachments
+        :returns: str, the rendered text
+        """
+        if self.is_static():
+            if self.static_output is None:
+                self.static_output = self.template.render({})
+            return self.static_output
+
+        templating_value_dict = {name: contact_dict[name] for name in self.row_variables if name in contact_dict}
+        if self.uses_attachments():
+            if ATTACHMENTS_VARIABLE in contact_dict:
+                # If there is column in the contacts dataset called "attachments" that takes priority, but we log a warning
+                if not self.warned_about_attachments_column:
+                    logging.warning("The input (contacts) dataset contains a column called 'attachments'. "
+                                    "If you want to display attachments data with the variable 'attachments' that column will have to be renamed")
+                    self.warned_about_attachments_column = True
+                templating_value_dict[ATTACHMENTS_VARIABLE] = contact_dict[ATTACHMENTS_VARIABLE]
+            else:
+                # Normal case - make attachments data available for JINJA
+                templating_value_dict[ATTACHMENTS_VARIABLE] = attachments_templating_dict
+        if self.cache_size <= 0:
+            return self.template.render(templating_value_dict)
+
+        # With the type of each value, as 1, 1.0 and True are equal keys but render differently
+        cache_key = tuple((name, type(templating_value_dict.get(name)), templating_value_dict.get(name)) for name in self.row_variables)
+        if ATTACHMENTS_VARIABLE in contact_dict:
+            attachments_value = contact_dict[ATTACHMENTS_VARIABLE]
+            cache_key += ((ATTACHMENTS_VARIABLE, type(attachments_value), attachments_value),)
+        try:
+            with self.cache_lock:
+                rendered = self.cache.get(cache_key)
+                if rendered is not None:
+                    self.cache.move_to_end(cache_key)
+                    self.cache_hits += 1
+                    return rendered
+        except TypeError:
+            # Some values cannot be hashed (e.g. lists), just render without caching
+            return self.template.render(templating_value_dict)
+        rendered = self.template.render(templating_value_dict)
+        with self.cache_lock:
+            self.cache[cache_key] = rendered
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return rendered
+
+
+def find_attribute_references(ast, variable_name):
+    """
+    :param ast: jinja2.nodes.Template, parsed template
+    :param variable_name: str
+    :returns: set of the attribute names accessed on the variable (`variable.name` or `variable['name']`),
+              or None if the variable is also used in another way, in which case any attribute may be needed
+    """
+    from jinja2 import nodes
+    variable_uses = [n for n in ast.find_all(nodes.Name) if n.name == variable_name]
+    attribute_names = set()
+    attribute_uses = 0
+    for node in ast.find_all((nodes.Getattr, nodes.Getitem)):
+        if isinstance(node.node, nodes.Name) and node.node.name == variable_name:
+            if isinstance(node, nodes.Getattr):
+                attribute_names.add(node.attr)
+            elif isinstance(node.arg, nodes.Const):
+                attribute_names.add(node.arg.value)
+            else:
+                return None
+            attribute_uses += 1
+    if attribute_uses != len(variable_uses):
+        return None
+    return attribute_names
+
+
+class RenderedEmail:
+    """
+    Email content for one contact, ready to be sent
+    :param sender: str, sender email
+    :param recipients: list of recipient addresses
+    :param subject: str
+    :param body: str, plain text or html
+    :param attachment_files: list of AttachmentFile sent with the email
+    """
+    def __init__(self, sender, recipients, subject, body, attachment_files):
+        self.sender = sender
+        self.recipients = recipients
+        self.subject = subject
+        self.body = body
+        self.attachment_files = attachment_files
+
+    def estimated_size(self):
+        """ :returns: int, approximate size in bytes of the message as sent: body and attachments base64 encoded, plus headers """
+        return MESSAGE_HEADERS_SIZE + len(self.subject or "") + base64_encoded_size(len(str(self.body).encode("utf-8"))) + \
+            sum(base64_encoded_size(attachment_file.size) for attachment_file in self.attachment_files)
+
+
+@timed("render_subject")
 def build_email_subject(use_subject_value, subject_line_template, subject_column, contact_dict):
+    """
+    :param subject_line_template: CompiledTemplate, used if use_subject_value
+    """
     if use_subject_value:
         if subject_line_template:
             try:
@@ -15,19 +156,15 @@ def build_email_subject(use_subject_value, subject_line_template, subject_column
     return email_subject
 
 
+@timed("render_body")
 def build_email_message_text(use_body_value, message_template, attachments_templating_dict, contact_dict, body_column, use_html_body_value):
+    """
+    :param message_template: CompiledTemplate, used if use_body_value
+    """
     if use_body_value:
         if message_template:
-            templating_value_dict = contact_dict.copy()
-            if "attachments" in templating_value_dict:
-                # If there is column in the contacts dataset called "attachments" that takes priority, but we log a warning
-                logging.warning("The input (contacts) dataset contains a column called 'attachments'. "
-                                "If you want to display attachments data with the variable 'attachments' that column will have to be renamed")
-            else:
-                # Normal case - make attachments data available for JINJA
-                templating_value_dict["attachments"] = attachments_templating_dict
             try:
-                email_text = message_template.render(templating_value_dict)
+                email_text = message_template.render(contact_dict, attachments_templating_dict)
             except Exception as exp:
                 raise Exception("Could not render body template: {} ".format(exp))
         else:
@@ -1,17 +1,14 @@
 from dss_selector_choices import DSSSelectorChoices, SENDER_SUFFIX
-from dku_support_detection import supports_messaging_channels_and_conditional_formatting
-import dataiku
+from dku_dss_api import list_mail_channels
 
 
 def do(payload, config, plugin_config, inputs):
-    dss_client = dataiku.api_client()
     parameter_name = payload.get("parameterName")
 
     if parameter_name == "mail_channel":
         choices = DSSSelectorChoices()
-        channels = []
-        if supports_messaging_channels_and_conditional_formatting(dss_client):
-            channels = dss_client.list_messaging_channels(as_type="objects", channel_family="mail")
+        # Cached for a short time, as the form asks for the choices each time it is opened
+        channels = list_mail_channels()
         for channel in channels:
             if 'use_current_user_as_sender' in dir(channel) and channel.use_current_user_as_sender:
                 # If the channel has a locked-down sender using current user, append `(user email)` to label and SENDER_SUFFIX flag to channel ID
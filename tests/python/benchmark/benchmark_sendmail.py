@@ -0,0 +1,364 @@
+"""
+Benchmark of the sendmail hot paths, with no DSS instance and no network needed:
+ - emails are sent to a local in-process SMTP sink (aiosmtpd), or to a stub DSS messaging channel, through the public send API of
+   the email clients - so connection pool, rate limiting and retries of temporary failures are part of what is measured
+ - contacts and attachment datasets are synthetic, of configurable size
+It reports messages/sec, p50/p99 latency per message, CPU time per stage and peak RSS, and saves them as JSON
+so that runs can be compared to spot regressions.
+
+Usage, from the plugin root:
+    PYTHONPATH=python-lib python tests/python/benchmark/benchmark_sendmail.py --contacts 2000 --output before.json
+    PYTHONPATH=python-lib python tests/python/benchmark/benchmark_sendmail.py --contacts 2000 --output after.json --compare before.json
+"""
+import argparse
+import io
+import json
+import logging
+import platform
+import random
+import socket
+import string
+import sys
+import threading
+import time
+import types
+from contextlib import contextmanager
+
+import pandas as pd
+from jinja2 import Environment, StrictUndefined
+
+BENCHMARK_PROJECT_KEY = "BENCHMARK"
+
+
+class FakeDataset:
+    """ In-memory stand-in for dataiku.Dataset, with the methods the plugin uses for attachments """
+    def __init__(self, name, df):
+        self.project_key = BENCHMARK_PROJECT_KEY
+        self.full_name = f"{BENCHMARK_PROJECT_KEY}.{name}"
+        self.df = df
+
+    def get_dataframe(self, limit=None, **kwargs):
+        return self.df.head(limit) if limit else self.df
+
+    @contextmanager
+    def raw_formatted_data(self, format=None, format_params=None):
+        buffer = io.BytesIO()
+        if format == "excel":
+            self.df.to_excel(buffer, index=False)
+        else:
+            buffer.write(self.df.to_csv(sep="\t", index=False).encode("utf-8"))
+        buffer.seek(0)
+        yield buffer
+
+
+class FakeMessagingChannel:
+    """ Stub of a DSS messaging channel - each send waits latency seconds, as an HTTP call to DSS would """
+    def __init__(self, latency):
+        self.id = "benchmark_channel"
+        self.type = "smtp"
+        self.sender = None
+        self.latency = latency
+        self.calls = 0
+        self.bytes_uploaded = 0
+
+    def send(self, project_key, to, subject, body, attachments=None, plain_text=False, sender=None):
+        self.calls += 1
+        self.bytes_uploaded += len(body) + sum(len(data) for _, data, _ in (attachments or []))
+        time.sleep(self.latency)
+
+
+class FakeDSSClient:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def list_messaging_channels(self, **kwargs):
+        return [self.channel]
+
+    def get_messaging_channel(self, channel_id):
+        return self.channel
+
+
+def install_fake_dataiku(channel):
+    """ Make `import dataiku` in the plugin modules resolve to a stub talking to the fake channel """
+    fake_dataiku = types.ModuleType("dataiku")
+    fake_dataiku.api_client = lambda: FakeDSSClient(channel)
+    fake_dataiku.default_project_key = lambda: BENCHMARK_PROJECT_KEY
+    sys.modules["dataiku"] = fake_dataiku
+
+
+class SmtpSink:
+    """
+    Local SMTP server accepting and discarding all emails, running in a background thread
+    :param failure_rate: float, fraction of the emails refused with a temporary (451) failure, to be retried by the client
+    :param seed: int, seed of the choice of the refused emails
+    """
+    def __init__(self, failure_rate=0.0, seed=0):
+        from aiosmtpd.controller import Controller
+        self.messages = 0
+        self.bytes_received = 0
+        self.temporary_failures = 0
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        with socket.socket() as free_socket:
+            free_socket.bind(("127.0.0.1", 0))
+            self.port = free_socket.getsockname()[1]
+        self.controller = Controller(self, hostname="127.0.0.1", port=self.port)
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.temporary_failures += 1
+            return "451 4.3.0 Temporary failure, try again later"
+        self.messages += 1
+        self.bytes_received += len(envelope.content)
+        return "250 OK"
+
+    def __enter__(self):
+        self.controller.start()
+        return self
+
+    def __exit__(self, *args):
+        self.controller.stop()
+
+
+class StageTimer:
+    """ Wall time and CPU time (of the calling thread only, so the SMTP sink is not counted) spent in each stage """
+    def __init__(self):
+        self.stages = {}
+        # Stages can run in several sending threads at once
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall_s = time.perf_counter() - wall_start
+            cpu_s = time.thread_time() - cpu_start
+            with self.lock:
+                totals = self.stages.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0})
+                totals["wall_s"] += wall_s
+                totals["cpu_s"] += cpu_s
+                totals["calls"] += 1
+
+
+def random_word(length=8):
+    return "".join(random.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def synthetic_contacts(rows, extra_columns):
+    data = {
+        "email": [f"contact{i}@example.com" for i in range(rows)],
+        "name": [random_word() for _ in range(rows)],
+        "amount": [random.randint(0, 10000) for _ in range(rows)],
+    }
+    for column_index in range(extra_columns):
+        data[f"extra_{column_index}"] = [random_word() for _ in range(rows)]
+    return pd.DataFrame(data)
+
+
+def synthetic_attachment(name, rows):
+    return FakeDataset(name, pd.DataFrame({
+        "id": range(rows),
+        "label": [random_word(12) for _ in range(rows)],
+        "value": [random.random() * 1000 for _ in range(rows)],
+    }))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_bytes():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def create_email_client(transport, args, sink, channel):
+    from dku_email_client import SmtpConfig, SmtpEmailClient, AsyncSmtpEmailClient, ChannelClient
+    from dku_rate_limiting import AdaptiveRateLimiter, RetryPolicy
+    if transport == "channel":
+        return ChannelClient(False, channel.id)
+    # Same client as the recipe creates, see create_email_client in recipe.py
+    rate_limiter = AdaptiveRateLimiter(args.smtp_max_rate) if args.smtp_max_rate > 0 else None
+    retry_policy = RetryPolicy(args.smtp_max_retries, base_delay=args.smtp_retry_delay_ms / 1000)
+    client_class = AsyncSmtpEmailClient if args.smtp_asyncio else SmtpEmailClient
+    return client_class(False, SmtpConfig("127.0.0.1", sink.port, False, False, None, None), args.smtp_connections, rate_limiter,
+                        0, retry_policy)
+
+
+def run_scenario(transport, args, contacts, attachment_datasets, channel):
+    from dku_attachment_handling import build_attachment_files, attachments_template_dict
+    from dku_concurrency import ordered_map, ordered_submit
+    from dku_metrics import METRICS
+    from email_utils import build_email_subject, build_email_message_text, CompiledTemplate
+
+    METRICS.reset()
+    timer = StageTimer()
+    latencies = []
+    failures = []
+    jinja_env = Environment(undefined=StrictUndefined)
+    body_source = "<p>Static body</p>" if args.static_template else \
+        "<p>Hello {{ name }}, your amount is {{ amount }}</p>{{ attachments.attachment_0.html_table }}"
+    body_template = CompiledTemplate(jinja_env, body_source)
+    subject_template = CompiledTemplate(jinja_env, "Report" if args.static_template else "Report for {{ name }}")
+
+    with timer.stage("export_attachments"):
+        attachment_files = build_attachment_files(attachment_datasets, args.attachment_format, False)
+    with timer.stage("attachments_templating"):
+        attachments_templating_dict = attachments_template_dict(attachment_datasets, BENCHMARK_PROJECT_KEY, False)
+
+    def render(contact):
+        with timer.stage("render"):
+            subject = build_email_subject(True, subject_template, None, contact)
+            body = build_email_message_text(True, body_template, attachments_templating_dict, contact, None, True)
+        return subject, body
+
+    def send(contact):
+        message_start = time.perf_counter()
+        subject, body = render(contact)
+        try:
+            with timer.stage(f"{transport}_send"):
+                email_client.send_email("sender@example.com", [contact["email"]], subject, body, attachment_files)
+        except Exception as exp:
+            failures.append(str(exp))
+        latencies.append(time.perf_counter() - message_start)
+
+    def submit(contact):
+        message_start = time.perf_counter()
+        subject, body = render(contact)
+        future = email_client.submit_email("sender@example.com", [contact["email"]], subject, body, attachment_files)
+        # Latency up to the reply of the server, not up to the turn of the email in the ordered results
+        future.add_done_callback(lambda _: latencies.append(time.perf_counter() - message_start))
+        return future
+
+    def finish(contact, future):
+        try:
+            future.result()
+        except Exception as exp:
+            failures.append(str(exp))
+
+    sink = SmtpSink(args.smtp_failure_rate, args.seed) if transport == "smtp" else None
+    if sink:
+        sink.__enter__()
+    try:
+        email_client = create_email_client(transport, args, sink, channel)
+        email_client.login()
+
+        run_start = time.perf_counter()
+        records = contacts.to_dict("records")
+        if transport == "smtp" and args.smtp_asyncio:
+            for _ in ordered_submit(submit, finish, records, args.smtp_max_in_flight):
+                pass
+        else:
+            # One sending thread per SMTP connection, as the recipe does
+            for _ in ordered_map(send, records, args.smtp_connections if transport == "smtp" else 1):
+                pass
+        elapsed = time.perf_counter() - run_start
+        email_client.quit()
+    finally:
+        if sink:
+            sink.__exit__()
+
+    latencies.sort()
+    result = {
+        "messages": len(latencies),
+        "failed": len(failures),
+        "elapsed_s": elapsed,
+        "messages_per_sec": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {"p50": 1000 * percentile(latencies, 0.5), "p99": 1000 * percentile(latencies, 0.99)},
+        "stages": timer.stages,
+        # Timings and counters of the plugin code itself (MIME encoding, sends, retries...)
+        "plugin_metrics": METRICS.summary_records(),
+    }
+    if sink:
+        result["bytes_on_wire"] = sink.bytes_received
+        result["temporary_failures"] = sink.temporary_failures
+    else:
+        result["channel_calls"] = channel.calls
+    return result
+
+
+def compare(results, previous, threshold):
+    """ Print the change of each scenario against a previous run, returns True if any regressed by more than threshold """
+    regressed = False
+    for transport, result in results["scenarios"].items():
+        previous_result = previous.get("scenarios", {}).get(transport)
+        if not previous_result:
+            continue
+        throughput_change = result["messages_per_sec"] / previous_result["messages_per_sec"] - 1
+        p99_change = result["latency_ms"]["p99"] / max(previous_result["latency_ms"]["p99"], 1e-9) - 1
+        is_regression = throughput_change < -threshold
+        regressed = regressed or is_regression
+        print(f"{transport}: throughput {throughput_change:+.1%}, p99 latency {p99_change:+.1%}" + (" REGRESSION" if is_regression else ""))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sendmail plugin without DSS nor network")
+    parser.add_argument("--contacts", type=int, default=1000, help="number of synthetic contacts")
+    parser.add_argument("--contact-columns", type=int, default=5, help="number of extra columns in the contacts")
+    parser.add_argument("--attachments", type=int, default=1, help="number of attachment datasets")
+    parser.add_argument("--attachment-rows", type=int, default=1000, help="number of rows of each attachment dataset")
+    parser.add_argument("--attachment-format", default="csv", choices=["csv", "excel", "send_no_attachments"])
+    parser.add_argument("--transport", default="all", choices=["all", "smtp", "channel"])
+    parser.add_argument("--channel-latency-ms", type=float, default=5.0, help="simulated duration of a DSS channel call")
+    parser.add_argument("--smtp-connections", type=int, default=1, help="SMTP connections of the pool, each with a sending thread")
+    parser.add_argument("--smtp-max-rate", type=float, default=0, help="maximum emails per second, 0 for no limit")
+    parser.add_argument("--smtp-asyncio", action="store_true", help="send with the asyncio SMTP client")
+    parser.add_argument("--smtp-max-in-flight", type=int, default=50, help="emails in flight with the asyncio SMTP client")
+    parser.add_argument("--smtp-failure-rate", type=float, default=0.0, help="fraction of the emails refused with a temporary failure")
+    parser.add_argument("--smtp-max-retries", type=int, default=3, help="retries of an email after a temporary failure")
+    parser.add_argument("--smtp-retry-delay-ms", type=float, default=10.0, help="delay ceiling of the first retry")
+    parser.add_argument("--static-template", action="store_true", help="use templates that do not depend on the row")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="throughput drop flagged as a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+    channel = FakeMessagingChannel(args.channel_latency_ms / 1000)
+    install_fake_dataiku(channel)
+
+    contacts = synthetic_contacts(args.contacts, args.contact_columns)
+    attachment_datasets = [synthetic_attachment(f"attachment_{i}", args.attachment_rows) for i in range(args.attachments)]
+    transports = ["smtp", "channel"] if args.transport == "all" else [args.transport]
+
+    results = {
+        "config": vars(args),
+        "python": platform.python_version(),
+        "scenarios": {transport: run_scenario(transport, args, contacts, attachment_datasets, channel) for transport in transports},
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+    for transport, result in results["scenarios"].items():
+        print(f"{transport}: {result['messages']} messages ({result['failed']} failed), {result['messages_per_sec']:.1f} msg/s, "
+              f"p50 {result['latency_ms']['p50']:.2f} ms, p99 {result['latency_ms']['p99']:.2f} ms")
+        for stage, totals in result["stages"].items():
+            print(f"    {stage}: cpu {totals['cpu_s']:.3f}s, wall {totals['wall_s']:.3f}s, {totals['calls']} calls")
+        for record in result["plugin_metrics"]:
+            if "total_ms" in record:
+                print(f"    plugin {record['stage']}: {record['count']} calls, total {record['total_ms'] / 1000:.3f}s")
+            else:
+                print(f"    plugin {record['stage']}: {record['count']}")
+    print(f"peak RSS: {results['peak_rss_bytes'] / 1024 / 1024:.1f} MB")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.compare:
+        with open(args.compare) as previous_file:
+            if compare(results, json.load(previous_file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Fixtures of the unit tests: a local SMTP server with pipelining (RFC 2920) and STARTTLS, whose replies can be set per test.
+`dataiku` only exists within DSS, the plugin modules importing it get a stand-in module.
+"""
+import asyncio
+import importlib.util
+import shutil
+import ssl
+import subprocess
+import sys
+import threading
+import types
+
+import pytest
+
+if "dataiku" not in sys.modules and importlib.util.find_spec("dataiku") is None:
+    fake_dataiku = types.ModuleType("dataiku")
+    fake_dataiku.default_project_key = lambda: "UNIT_TESTS"
+    sys.modules["dataiku"] = fake_dataiku
+
+
+def address_of(argument):
+    """ :returns: str, the address of a MAIL FROM:<...> or RCPT TO:<...> argument """
+    return argument.split(":", 1)[1].strip().strip("<>")
+
+
+class SmtpSession(asyncio.Protocol):
+    """ Server side of one SMTP connection """
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = bytearray()
+        self.in_data = False
+        self.data_lines = []
+        self.sender = None
+        self.recipients = []
+        self.messages = 0
+        self.tls = False
+        # Between STARTTLS and the end of the handshake, lines are kept until the TLS transport replaces the plain one
+        self.tls_pending = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.append(self)
+        self.reply("220 localhost ESMTP unit tests")
+
+    def reply(self, line):
+        self.transport.write(line.encode("ascii") + b"\r\n")
+
+    def data_received(self, data):
+        self.buffer += data
+        if not self.tls_pending:
+            self.process_lines()
+
+    def process_lines(self):
+        commands = 0
+        while not self.tls_pending and not self.transport.is_closing():
+            end = self.buffer.find(b"\r\n")
+            if end < 0:
+                break
+            line = bytes(self.buffer[:end]).decode("utf-8")
+            del self.buffer[:end + 2]
+            if self.in_data:
+                self.data_line(line)
+                continue
+            commands += 1
+            self.command(line)
+        self.server.max_commands_per_read = max(self.server.max_commands_per_read, commands)
+
+    def command(self, line):
+        verb, _, argument = line.partition(" ")
+        verb = verb.upper()
+        if verb == "EHLO":
+            extensions = ["8BITMIME"]
+            if self.server.pipelining:
+                extensions.append("PIPELINING")
+            if self.server.tls_context and not self.tls:
+                extensions.append("STARTTLS")
+            self.reply("\r\n".join(["250-localhost"] + [f"250-{extension}" for extension in extensions[:-1]] + [f"250 {extensions[-1]}"]))
+        elif verb == "HELO":
+            self.reply("250 localhost")
+        elif verb == "STARTTLS":
+            self.reply("220 Ready to start TLS")
+            self.tls_pending = True
+            asyncio.ensure_future(self.start_tls())
+        elif verb == "MAIL":
+            self.sender = address_of(argument)
+            self.recipients = []
+            self.reply("550 Sender refused" if self.sender in self.server.refused_senders else "250 OK")
+        elif verb == "RCPT":
+            recipient = address_of(argument)
+            if recipient in self.server.refused_recipients:
+                self.reply("550 Recipient refused")
+            elif self.server.temporary_failures.get(recipient, 0) > 0:
+                self.server.temporary_failures[recipient] -= 1
+                self.reply("451 Try again later")
+            else:
+                self.recipients.append(recipient)
+                self.reply("250 OK")
+        elif verb == "DATA":
+            if self.sender is None or self.sender in self.server.refused_senders or not self.recipients:
+                self.reply("554 No valid recipients")
+            else:
+                self.in_data = True
+                self.data_lines = []
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+        elif verb == "RSET":
+            self.sender = None
+            self.recipients = []
+            self.reply("250 OK")
+        elif verb == "QUIT":
+            self.reply("221 Bye")
+            self.transport.close()
+        else:
+            self.reply("502 Command not implemented")
+
+    def data_line(self, line):
+        if line != ".":
+            self.data_lines.append(line[1:] if line.startswith(".") else line)
+            return
+        self.in_data = False
+        if self.server.temporary_data_failures > 0:
+            self.server.temporary_data_failures -= 1
+            self.reply("451 Temporary failure, try again")
+        else:
+            self.messages += 1
+            self.server.messages.append((self.sender, self.recipients, "\r\n".join(self.data_lines)))
+            self.reply("250 Queued")
+        self.sender = None
+        self.recipients = []
+
+    async def start_tls(self):
+        # The client waits for the TLS handshake, nothing else was sent in clear
+        self.buffer.clear()
+        loop = asyncio.get_event_loop()
+        self.transport = await loop.start_tls(self.transport, self, self.server.tls_context, server_side=True)
+        self.tls = True
+        # The first commands over TLS may have arrived before start_tls returned, they are answered on the new transport
+        self.tls_pending = False
+        self.process_lines()
+
+
+class PipeliningSmtpServer:
+    """
+    SMTP server running on an event loop in a background thread, recording the messages it accepts.
+    The attributes set after start change its replies: refused senders and recipients get 550, temporary_failures gives the number of
+    451 replies to RCPT of each recipient, temporary_data_failures the number of messages answered 451 at the end of DATA
+    """
+    def __init__(self, pipelining=True, tls_context=None):
+        self.pipelining = pipelining
+        self.tls_context = tls_context
+        self.refused_senders = set()
+        self.refused_recipients = set()
+        self.temporary_failures = {}
+        self.temporary_data_failures = 0
+        self.messages = []
+        self.connections = []
+        self.max_commands_per_read = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.server = None
+        self.port = None
+
+    def start(self):
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            self.loop.create_server(lambda: SmtpSession(self), "127.0.0.1", 0), self.loop).result()
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self.server.close()
+        asyncio.run_coroutine_threadsafe(self.server.wait_closed(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+@pytest.fixture
+def smtp_server():
+    server = PipeliningSmtpServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def smtp_server_without_pipelining():
+    server = PipeliningSmtpServer(pipelining=False)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope="session")
+def self_signed_certificate(tmp_path_factory):
+    """ :returns: tuple (certificate file, key file) of a self-signed certificate for localhost """
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is needed to generate a test certificate")
+    directory = tmp_path_factory.mktemp("certificate")
+    certificate_file, key_file = str(directory / "cert.pem"), str(directory / "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-keyout", key_file, "-out", certificate_file], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return certificate_file, key_file
+
+
+@pytest.fixture
+def smtp_server_with_tls(self_signed_certificate):
+    tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    tls_context.load_cert_chain(*self_signed_certificate)
+    server = PipeliningSmtpServer(tls_context=tls_context)
+    server.start()
+    yield server
+    server.stop()
@@ -0,0 +1,107 @@
+import smtplib
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+from dku_async_smtp import envelope_bytes
+from dku_email_client import SmtpConfig, SmtpEmailClient, AsyncSmtpEmailClient
+from dku_rate_limiting import RetryPolicy
+
+SENDER = "sender@example.com"
+
+
+@contextmanager
+def logged_in(server, client_class=AsyncSmtpEmailClient, use_tls=False, **kwargs):
+    client = client_class(True, SmtpConfig("127.0.0.1", server.port, use_tls, False, None, None), **kwargs)
+    client.login()
+    try:
+        yield client
+    finally:
+        client.quit()
+
+
+def send(client, recipients, subject="Hello"):
+    client.send_email(SENDER, recipients, subject, "Body of the email", [])
+
+
+def test_envelope_bytes():
+    assert envelope_bytes(SENDER, ["a@example.com", "b@example.com"]) == \
+        b"mail FROM:<sender@example.com>\r\nrcpt TO:<a@example.com>\r\nrcpt TO:<b@example.com>\r\ndata\r\n"
+
+
+def test_pipelined_send(smtp_server):
+    with logged_in(smtp_server) as client:
+        futures = [client.submit_email(SENDER, [f"contact{i}@example.com"], f"Subject {i}", "Body", []) for i in range(10)]
+        for future in futures:
+            future.result()
+    assert [recipients for _, recipients, _ in smtp_server.messages] == [[f"contact{i}@example.com"] for i in range(10)]
+    assert all(f"Subject: Subject {i}" in smtp_server.messages[i][2] for i in range(10))
+    assert len(smtp_server.connections) == 1
+    # MAIL, RCPT and DATA were sent together
+    assert smtp_server.max_commands_per_read >= 3
+
+
+def test_send_without_pipelining(smtp_server_without_pipelining):
+    with logged_in(smtp_server_without_pipelining) as client:
+        for i in range(3):
+            send(client, [f"contact{i}@example.com"])
+    assert len(smtp_server_without_pipelining.messages) == 3
+    assert smtp_server_without_pipelining.max_commands_per_read == 1
+
+
+def test_refused_recipient(smtp_server):
+    smtp_server.refused_recipients.add("refused@example.com")
+    with logged_in(smtp_server) as client:
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            send(client, ["ok@example.com", "refused@example.com"])
+        # The connection is still usable
+        send(client, ["next@example.com"])
+    assert [recipients for _, recipients, _ in smtp_server.messages] == [["ok@example.com"], ["next@example.com"]]
+    assert len(smtp_server.connections) == 1
+
+
+def test_refused_sender(smtp_server):
+    smtp_server.refused_senders.add(SENDER)
+    with logged_in(smtp_server) as client:
+        with pytest.raises(smtplib.SMTPSenderRefused):
+            send(client, ["contact@example.com"])
+        smtp_server.refused_senders.clear()
+        send(client, ["contact@example.com"])
+    assert len(smtp_server.messages) == 1
+    assert len(smtp_server.connections) == 1
+
+
+def test_temporary_failures_are_retried(smtp_server):
+    smtp_server.temporary_failures["busy@example.com"] = 2
+    smtp_server.temporary_data_failures = 1
+    with logged_in(smtp_server, retry_policy=RetryPolicy(max_retries=3, base_delay=0.01)) as client:
+        send(client, ["busy@example.com"])
+    assert [recipients for _, recipients, _ in smtp_server.messages] == [["busy@example.com"]]
+
+
+def test_temporary_failure_without_retries(smtp_server):
+    smtp_server.temporary_failures["busy@example.com"] = 1
+    with logged_in(smtp_server, retry_policy=RetryPolicy(max_retries=0)) as client:
+        with pytest.raises(smtplib.SMTPRecipientsRefused) as refused:
+            send(client, ["busy@example.com"])
+    assert refused.value.recipients["busy@example.com"][0] == 451
+    assert smtp_server.messages == []
+
+
+def test_reconnects_after_max_messages_per_connection(smtp_server):
+    with logged_in(smtp_server, max_messages_per_connection=2) as client:
+        futures = [client.submit_email(SENDER, [f"contact{i}@example.com"], "Hello", "Body", []) for i in range(5)]
+        for future in futures:
+            future.result()
+    assert [session.messages for session in smtp_server.connections] == [2, 2, 1]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="The asyncio client needs Python 3.7 or later to use TLS")
+@pytest.mark.parametrize("client_class", [SmtpEmailClient, AsyncSmtpEmailClient])
+def test_starttls_with_self_signed_certificate(smtp_server_with_tls, client_class):
+    # Both clients accept the certificate of a relay they cannot verify, as smtplib does by default
+    with logged_in(smtp_server_with_tls, client_class, use_tls=True) as client:
+        send(client, ["contact@example.com"])
+    assert len(smtp_server_with_tls.messages) == 1
+    assert all(session.tls for session in smtp_server_with_tls.connections)
@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+from dku_attachment_handling import attachment_key, PartitionedAttachments
+
+
+class AttachmentDataset:
+    def __init__(self, full_name, df):
+        self.full_name = full_name
+        self.df = df
+
+    def get_dataframe(self):
+        return self.df
+
+
+@pytest.mark.parametrize("key_value, expected", [
+    (5, "5"),
+    (5.0, "5"),
+    ("5", "5"),
+    (5.5, "5.5"),
+    ("abc", "abc"),
+    (None, None),
+    (float("nan"), None),
+    (pd.NA, None),
+])
+def test_attachment_key(key_value, expected):
+    assert attachment_key(key_value) == expected
+
+
+def test_keys_of_different_column_types_match():
+    # A bigint column with missing values is read as floats
+    orders = pd.DataFrame({"customer_id": [5, None, 7, 5], "amount": [10, 20, 30, 40]})
+    attachments = PartitionedAttachments([AttachmentDataset("PROJECT.orders", orders)], "csv", "customer_id")
+    for key_value in (5, "5", 5.0):
+        (attachment_file,) = attachments.files_for(key_value)
+        assert attachment_file.data.decode("utf-8").splitlines() == ["customer_id\tamount", "5.0\t10", "5.0\t40"]
+    (attachment_file,) = attachments.files_for(None)
+    assert attachment_file.data.decode("utf-8").splitlines() == ["customer_id\tamount"]
@@ -0,0 +1,163 @@
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from dku_concurrency import ordered_map, Pipeline, PipelineStage, ShardedRunner
+
+
+def slow_square(item):
+    time.sleep(random.uniform(0, 0.005))
+    return item * item
+
+
+def fail_on(failing_item):
+    def func(item):
+        if item == failing_item:
+            raise ValueError(f"Item {item} failed")
+        return item
+    return func
+
+
+def running_threads(prefix):
+    return [thread for thread in threading.enumerate() if thread.name.startswith(prefix)]
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_ordered_map_keeps_the_input_order(max_workers):
+    assert list(ordered_map(slow_square, range(50), max_workers)) == [item * item for item in range(50)]
+
+
+def test_ordered_map_reads_items_lazily():
+    read_items = []
+
+    def items():
+        for item in range(100):
+            read_items.append(item)
+            yield item
+
+    results = ordered_map(slow_square, items(), 4, max_pending=8)
+    assert next(results) == 0
+    assert len(read_items) <= 8
+    results.close()
+
+
+def test_ordered_map_raises_the_error_of_an_item_and_stops_its_workers():
+    results = ordered_map(fail_on(3), range(100), 4)
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError, match="Item 3 failed"):
+        next(results)
+    assert running_threads("ThreadPoolExecutor") == []
+
+
+def test_ordered_map_stops_its_workers_when_closed():
+    results = ordered_map(slow_square, range(100), 4)
+    next(results)
+    results.close()
+    assert running_threads("ThreadPoolExecutor") == []
+
+
+def pipeline_of(*stages, queue_size=4):
+    return Pipeline(list(stages), queue_size=queue_size)
+
+
+def test_pipeline_keeps_the_input_order():
+    pipeline = pipeline_of(PipelineStage("square", slow_square, 4), PipelineStage("negate", lambda item: -item, 3))
+    assert list(pipeline.run(range(100))) == [-item * item for item in range(100)]
+    assert [counters.items for counters in pipeline.all_counters()] == [100, 100, 100, 100]
+    assert running_threads("pipeline-") == []
+
+
+def test_ordered_stage_gets_the_items_in_input_order():
+    seen_items = []
+
+    def record(item):
+        seen_items.append(item)
+        return item
+
+    pipeline = pipeline_of(PipelineStage("square", slow_square, 4), PipelineStage("record", record, 4, ordered=True),
+                           PipelineStage("square_root", lambda item: round(item ** 0.5), 4))
+    assert list(pipeline.run(range(100))) == list(range(100))
+    assert seen_items == [item * item for item in range(100)]
+
+
+def test_early_failure_of_a_stage_is_raised_and_stops_the_pipeline():
+    send_calls = []
+    pipeline = pipeline_of(PipelineStage("render", fail_on(0), 4), PipelineStage("send", send_calls.append, 2))
+    with pytest.raises(ValueError, match="Item 0 failed"):
+        list(pipeline.run(range(1000)))
+    assert running_threads("pipeline-") == []
+    # The failed item is not passed to the next stages, and the input is not read to the end
+    assert 0 not in send_calls
+    assert pipeline.read_counters.items < 1000
+
+
+def test_failure_to_read_the_input_is_raised():
+    def items():
+        yield from range(10)
+        raise IOError("Could not read the next row")
+
+    results = pipeline_of(PipelineStage("square", slow_square, 2)).run(items())
+    assert [next(results) for _ in range(10)] == [item * item for item in range(10)]
+    with pytest.raises(IOError, match="Could not read the next row"):
+        next(results)
+    assert running_threads("pipeline-") == []
+
+
+def test_pipeline_stops_when_its_results_are_closed():
+    results = pipeline_of(PipelineStage("square", slow_square, 4)).run(range(1000))
+    assert next(results) == 0
+    results.close()
+    assert running_threads("pipeline-") == []
+
+
+needs_fork = pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="Sharding needs to fork processes")
+
+
+def with_pid(items):
+    for item in items:
+        yield item, os.getpid()
+
+
+@needs_fork
+def test_sharded_runner_keeps_the_input_order():
+    runner = ShardedRunner(lambda items: (item * item for item in items), 3, chunk_size=7, finalizer=os.getpid)
+    assert list(runner.run(range(100))) == [item * item for item in range(100)]
+    # Each worker process ran its finalizer, blocks of 7 consecutive items went to the workers in turn
+    assert len(set(runner.finalizer_results)) == 3 and os.getpid() not in runner.finalizer_results
+    assert runner.shard_items == [35, 35, 30]
+
+
+@needs_fork
+def test_items_with_the_same_key_go_to_the_same_process():
+    items = [f"{name}@example.com" for name in ("a", "b", "c", "d")] * 10 + ["A@EXAMPLE.com"]
+    results = list(ShardedRunner(with_pid, 3, shard_key=lambda item: item).run(items))
+    assert [item for item, _ in results] == items
+    pids = {}
+    for item, pid in results:
+        assert pids.setdefault(item.lower(), pid) == pid
+
+
+@needs_fork
+def test_failure_in_a_worker_process_is_raised_in_the_caller():
+    runner = ShardedRunner(lambda items: map(fail_on(42), items), 2, chunk_size=10)
+    results = runner.run(range(100))
+    with pytest.raises(Exception, match="(?s)Sending process 0 failed.*Item 42 failed"):
+        list(results)
+    assert multiprocessing.active_children() == []
+
+
+@needs_fork
+def test_worker_process_stopping_unexpectedly_is_raised_in_the_caller():
+    def process_stream(items):
+        for item in items:
+            if item == 5:
+                os._exit(3)
+            yield item
+
+    with pytest.raises(Exception, match=r"Sending process 0 stopped unexpectedly \(exit code 3\)"):
+        list(ShardedRunner(process_stream, 2, chunk_size=10).run(range(100)))
+    assert multiprocessing.active_children() == []
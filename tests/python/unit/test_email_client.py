@@ -0,0 +1,39 @@
+import dku_email_client
+from dku_email_client import AttachmentFile, ChannelClient, DryRunEmailClient, SmtpEmailClient
+
+
+class MessagingChannel:
+    type = "mail"
+    sender = None
+
+    def __init__(self):
+        self.calls = []
+
+    def send(self, project_key, recipients, subject, body, attachments=None, plain_text=False, sender=None):
+        self.calls.append((recipients, attachments))
+
+
+def test_channel_client_reads_each_attachment_once(monkeypatch):
+    channel = MessagingChannel()
+    monkeypatch.setattr(dku_email_client, "get_messaging_channel", lambda channel_id: channel)
+    client = ChannelClient(False, "channel", max_batch_size=2)
+    attachment_file = AttachmentFile("data.csv", "text", "csv", b"a,b\n1,2\n")
+    client.send_email("sender@example.com", ["a@example.com", "b@example.com", "c@example.com"], "Subject", "Body", [attachment_file])
+    client.send_email("sender@example.com", ["d@example.com"], "Subject", "Body", [attachment_file])
+    client.quit()
+    assert [recipients for recipients, _ in channel.calls] == [["a@example.com", "b@example.com"], ["c@example.com"], ["d@example.com"]]
+    assert all(attachments == [("data.csv", b"a,b\n1,2\n", "text/csv")] for _, attachments in channel.calls)
+    # The content was read once, every call got the same bytes
+    assert len({id(attachments[0][1]) for _, attachments in channel.calls}) == 1
+
+
+def test_dry_run_builds_the_messages_without_a_transport():
+    client = DryRunEmailClient(False)
+    assert not isinstance(client, SmtpEmailClient)
+    assert not hasattr(client, "open_connection") and not hasattr(client, "send_single_email")
+    attachment_file = AttachmentFile("data.csv", "text", "csv", b"a,b\n1,2\n")
+    size = client.message_size("sender@example.com", ["a@example.com", "b@example.com"], "Subject", "Body", [attachment_file])
+    encoded_attachments = client.encoded_attachments([attachment_file])
+    assert size == sum(len(b"".join(client.build_message("sender@example.com", [recipient], "Subject", "Body", encoded_attachments)))
+                       for recipient in ["a@example.com", "b@example.com"])
+    client.quit()
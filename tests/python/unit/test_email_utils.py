@@ -0,0 +1,9 @@
+from jinja2 import Environment
+
+from email_utils import CompiledTemplate
+
+
+def test_values_equal_but_of_different_types_are_rendered_each():
+    template = CompiledTemplate(Environment(), "Value: {{ value }}")
+    assert [template.render({"value": value}, {}) for value in (1, 1.0, True, 1)] == ["Value: 1", "Value: 1.0", "Value: True", "Value: 1"]
+    assert template.cache_hits == 1
@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+from dku_concurrency import ordered_map, Pipeline, PipelineStage
+from dku_recipients import check_recipients, DuplicateFilter, DUPLICATE_CLAIMS_KEY
+
+
+@pytest.mark.parametrize("recipients, expected", [
+    ("a@example.com", (["a@example.com"], [])),
+    ("  a@example.com ", (["a@example.com"], [])),
+    ("a@example.com, b@example.com,", (["a@example.com", "b@example.com"], [])),
+    ('["a@example.com", "B@example.com", "b@example.com"]', (["a@example.com", "B@example.com"], [])),
+    ("Name <a@example.com>, A@EXAMPLE.com", (["Name <a@example.com>"], [])),
+    ("not an address, a@example.com", (["a@example.com"], ["not an address"])),
+    ('"quoted"@example.com', ([], ['"quoted"@example.com'])),
+    ("", ([], [])),
+    (None, ([], [])),
+    (float("nan"), ([], [])),
+])
+def test_check_recipients(recipients, expected):
+    assert check_recipients(recipients) == expected
+
+
+def test_claims_of_identical_emails():
+    duplicate_filter = DuplicateFilter()
+    claims, duplicate_claims = duplicate_filter.claim_recipients(["a@example.com", "b@example.com"], ("sender", "subject", "body"))
+    assert [claim.recipient for claim in claims] == ["a@example.com", "b@example.com"]
+    assert duplicate_claims == []
+    # Same mailbox, whatever the case or display name
+    claims_again, duplicate_claims = duplicate_filter.claim_recipients(["Name <A@example.com>"], ("sender", "subject", "body"))
+    assert claims_again == [] and duplicate_claims == [claims[0]]
+    # Another email to the same recipient
+    other_claims, _ = duplicate_filter.claim_recipients(["a@example.com"], ("sender", "other subject", "body"))
+    assert len(other_claims) == 1
+
+
+def test_failed_claim_can_be_claimed_again():
+    duplicate_filter = DuplicateFilter()
+    content = ("sender", "subject", "body")
+    (claim,), _ = duplicate_filter.claim_recipients(["a@example.com"], content)
+    duplicate_filter.settle(claim, False)
+    (claim,), _ = duplicate_filter.claim_recipients(["a@example.com"], content)
+    duplicate_filter.settle(claim, True)
+    assert duplicate_filter.claim_recipients(["a@example.com"], content) == ([], [])
+    assert duplicate_filter.duplicates == 1
+
+
+def test_settle_rows_of_a_partly_delivered_row():
+    duplicate_filter = DuplicateFilter()
+    content = ("sender", "subject", "body")
+    first_row, second_row = {}, {}
+    duplicate_filter.claim_row(first_row, ["a@example.com", "b@example.com"], content)
+    assert duplicate_filter.claim_row(second_row, ["a@example.com", "b@example.com"], content) == []
+    first_row["sendmail_status"] = "FAILED"
+    second_row["sendmail_status"] = "SKIPPED"
+    # Sent one recipient at a time, the first row was delivered to a but failed for b
+    settled = list(duplicate_filter.settle_rows([first_row, second_row], lambda row, recipient: recipient == "a@example.com"))
+    assert [row["sendmail_status"] for row in settled] == ["FAILED", "FAILED"]
+    assert second_row["sendmail_error"] == "Not sent to b@example.com: the same email failed for a previous row"
+    assert DUPLICATE_CLAIMS_KEY not in first_row and DUPLICATE_CLAIMS_KEY not in second_row
+    # a is not sent again by a later row, b is
+    assert duplicate_filter.claim_row({}, ["a@example.com", "b@example.com"], content) == ["b@example.com"]
+
+
+class SendingRun:
+    """
+    Rows rendered and sent by pools of workers as in the recipe, claims taken in input order between the two.
+    Each row is a list of recipients of the same email, the first rows take longest to render so they finish after the next ones
+    """
+    def __init__(self, rows, failing_rows=()):
+        self.rows = rows
+        self.failing_rows = set(failing_rows)
+        self.duplicate_filter = DuplicateFilter()
+        self.deliveries = []
+        self.lock = threading.Lock()
+
+    def render(self, index):
+        time.sleep(0.01 * max(0, 3 - index))
+        return {"index": index, "recipients": self.rows[index]}
+
+    def claim(self, contact_dict):
+        contact_dict["recipients"] = self.duplicate_filter.claim_row(contact_dict, contact_dict["recipients"], ("sender", "subject", "body"))
+        if not contact_dict["recipients"]:
+            contact_dict["sendmail_status"] = "SKIPPED"
+        return contact_dict
+
+    def send(self, contact_dict):
+        if contact_dict.get("sendmail_status") == "SKIPPED":
+            return contact_dict
+        if contact_dict["index"] in self.failing_rows:
+            contact_dict["sendmail_status"] = "FAILED"
+            return contact_dict
+        with self.lock:
+            self.deliveries.extend((recipient, contact_dict["index"]) for recipient in contact_dict["recipients"])
+        contact_dict["sendmail_status"] = "SUCCESS"
+        return contact_dict
+
+    def run(self, workers, use_pipeline=False):
+        if use_pipeline:
+            results = Pipeline([PipelineStage("render", self.render, workers),
+                                PipelineStage("claim", self.claim, ordered=True),
+                                PipelineStage("send", self.send, workers)], queue_size=4).run(range(len(self.rows)))
+        else:
+            results = ordered_map(self.send, map(self.claim, ordered_map(self.render, range(len(self.rows)), workers)), workers)
+        settled = self.duplicate_filter.settle_rows(results, lambda contact_dict, recipient: False)
+        return [(row["sendmail_status"], row.get("sendmail_error")) for row in settled]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+@pytest.mark.parametrize("use_pipeline", [False, True])
+def test_first_of_identical_rows_sends_the_email(workers, use_pipeline):
+    run = SendingRun([["a@example.com"], ["a@example.com"], ["a@example.com", "b@example.com"], ["b@example.com"]])
+    statuses = run.run(workers, use_pipeline)
+    assert [status for status, _ in statuses] == ["SUCCESS", "SKIPPED", "SUCCESS", "SKIPPED"]
+    assert sorted(run.deliveries) == [("a@example.com", 0), ("b@example.com", 2)]
+
+
+def test_failed_email_is_sent_again_by_the_next_row():
+    # One worker: each row is settled before the next one is claimed
+    run = SendingRun([["a@example.com"]] * 3, failing_rows=[0])
+    assert [status for status, _ in run.run(1)] == ["FAILED", "SUCCESS", "SKIPPED"]
+    assert run.deliveries == [("a@example.com", 1)]
+
+
+@pytest.mark.parametrize("use_pipeline", [False, True])
+def test_rows_claimed_while_the_email_failed_are_failed(use_pipeline):
+    # Several workers: all rows are claimed before the first one is settled, none can say the email was sent
+    run = SendingRun([["a@example.com"]] * 3, failing_rows=[0])
+    statuses = run.run(4, use_pipeline)
+    assert statuses[0][0] == "FAILED"
+    for status, error in statuses[1:]:
+        assert status in ("FAILED", "SUCCESS")
+        if status == "FAILED":
+            assert error == "Not sent to a@example.com: the same email failed for a previous row"
+    assert len(run.deliveries) == sum(status == "SUCCESS" for status, _ in statuses)
+    assert len(run.deliveries) <= 1
@@ -0,0 +1,86 @@
+import json
+import os
+
+import pytest
+
+from dku_send_journal import SendJournal, with_row_keys, ROW_KEY_COLUMN
+
+
+def test_resume_after_a_truncated_last_line(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = SendJournal(path, resume=False)
+    journal.record_delivery("row1", "a@example.com")
+    journal.record_row("row1", {"sendmail_status": "SUCCESS"})
+    journal.close()
+    with open(path, "a", encoding="utf-8") as journal_file:
+        journal_file.write('{"type": "delivered", "key": "row2", "recip')
+    resumed = SendJournal(path, resume=True)
+    assert resumed.is_delivered("row1", "a@example.com")
+    assert not resumed.is_delivered("row2", "b@example.com")
+    assert resumed.completed_row("row1") == {"sendmail_status": "SUCCESS"}
+    # New entries still start on a line of their own once the truncated one is ignored
+    resumed.record_delivery("row2", "b@example.com")
+    resumed.close()
+    assert SendJournal(path, resume=True).is_delivered("row2", "b@example.com")
+
+
+def test_only_rows_with_a_final_status_are_replayed(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = SendJournal(path, resume=False)
+    for row_key, status in [("success", "SUCCESS"), ("skipped", "SKIPPED"), ("invalid", "INVALID"), ("failed", "FAILED"),
+                            ("failed_then_sent", "FAILED"), ("failed_then_sent", "SUCCESS"), ("sent_then_failed", "SUCCESS"),
+                            ("sent_then_failed", "FAILED")]:
+        journal.record_row(row_key, {"sendmail_status": status})
+    journal.close()
+    resumed = SendJournal(path, resume=True)
+    assert sorted(resumed.completed_rows) == ["failed_then_sent", "invalid", "skipped", "success"]
+
+
+def test_deliveries_of_the_current_run_are_known(tmp_path):
+    journal = SendJournal(str(tmp_path / "journal.jsonl"), resume=False)
+    journal.record_delivery("row1", "a@example.com")
+    assert journal.is_delivered("row1", "a@example.com")
+    assert not journal.is_delivered("row1", "b@example.com")
+    journal.close()
+
+
+def test_not_resuming_starts_a_new_journal(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = SendJournal(path, resume=False)
+    journal.record_delivery("row1", "a@example.com")
+    journal.close()
+    SendJournal(path, resume=False).close()
+    assert not SendJournal(path, resume=True).is_delivered("row1", "a@example.com")
+
+
+@pytest.mark.parametrize("key_column", [None, "id"])
+def test_repeated_rows_get_their_own_keys(key_column):
+    rows = [{"id": 1, "email": "a@example.com"}, {"id": 2, "email": "b@example.com"}, {"id": 1, "email": "a@example.com"},
+            {"id": 1, "email": "a@example.com"}]
+    row_keys = [row[ROW_KEY_COLUMN] for row in with_row_keys(rows, key_column)]
+    assert len(set(row_keys)) == 4
+    assert row_keys[2] == row_keys[0] + "#2" and row_keys[3] == row_keys[0] + "#3"
+    # Keys do not depend on the order of the columns, nor on other runs
+    same_rows = [{"email": row["email"], "id": row["id"]} for row in rows]
+    assert [row[ROW_KEY_COLUMN] for row in with_row_keys(same_rows, key_column)] == row_keys
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork")
+def test_forked_process_writes_to_the_same_journal(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = SendJournal(path, resume=False)
+    journal.record_delivery("row1", "a@example.com")
+    pid = os.fork()
+    if pid == 0:
+        try:
+            journal.reopen_after_fork()
+            journal.record_delivery("row2", "b@example.com")
+            journal.close()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    journal.record_delivery("row3", "c@example.com")
+    journal.close()
+    with open(path, encoding="utf-8") as journal_file:
+        entries = [json.loads(line) for line in journal_file]
+    assert sorted(entry["key"] for entry in entries) == ["row1", "row2", "row3"]